@@ -0,0 +1,4 @@
+"""
+Offline benchmarks with a simulated Globus Transfer service.
+
+"""
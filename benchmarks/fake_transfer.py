@@ -0,0 +1,280 @@
+"""
+In-process simulation of the Globus Transfer service for offline benchmarks.
+
+"""
+import time
+import uuid
+import random
+import itertools
+import datetime
+import threading
+import collections
+
+
+class FakeResponse(dict):
+    """A dict standing in for a GlobusHTTPResponse"""
+    @property
+    def data(self):
+        return self
+
+
+class FakePaginator:
+    """Stand-in for the result of TransferClient.paginated.<method>(...)"""
+    def __init__(self, fetch_page):
+        self._fetch_page = fetch_page
+
+    def items(self):
+        offset = 0
+        while True:
+            page = self._fetch_page(offset)
+            yield from page["DATA"]
+            offset += len(page["DATA"])
+            if not page["DATA"] or offset >= page["total"]:
+                break
+
+
+class FakePaginated:
+    """Stand-in for TransferClient.paginated"""
+    def __init__(self, client):
+        self._client = client
+
+    def task_list(self, filter=None, limit=None, **kwargs):
+        return FakePaginator(lambda offset: self._client.task_list(filter=filter, limit=limit, offset=offset))
+
+    def task_event_list(self, task_id, limit=None, **kwargs):
+        return FakePaginator(lambda offset: self._client.task_event_list(task_id, limit=limit, offset=offset))
+
+
+class FakeTransferClient:
+    """
+    Simulated TransferClient
+
+    Every endpoint serves the same synthetic tree below any path: each
+    directory holds `files_per_dir` files ("f<i>.dat") and, down to `depth`
+    levels, `dirs_per_level` subdirectories ("d<i>"). Tasks stay ACTIVE for
+    `polls_to_complete` status checks (0 means they finish as soon as they are
+    submitted) and then fail with probability `failure_rate`. Endpoint
+    activation fails with probability `error_rate`. Every call sleeps for
+    `latency` seconds and is counted in `calls`.
+
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, failure_rate=0.0, depth=1, dirs_per_level=2,
+                 files_per_dir=10, file_size=1024 ** 2, polls_to_complete=0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.failure_rate = failure_rate
+        self.depth = depth
+        self.dirs_per_level = dirs_per_level
+        self.files_per_dir = files_per_dir
+        self.file_size = file_size
+        self.polls_to_complete = polls_to_complete
+        self.calls = collections.Counter()
+        self.paginated = FakePaginated(self)
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._tasks = {}
+        self._polls = {}
+
+    def _call(self, method):
+        """Count the call and simulate the round trip"""
+        with self._lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _chance(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def _depth_of(self, path):
+        """Depth of a path in the synthetic tree"""
+        return sum(1 for part in path.split("/") if part.startswith("d") and part[1:].isdigit())
+
+    def _entries(self, path):
+        """Entries of a directory in the synthetic tree"""
+        entries = [
+            {"name": f"f{i}.dat", "type": "file", "size": self.file_size, "last_modified": "2020-01-01 00:00:00+00:00"}
+            for i in range(self.files_per_dir)
+        ]
+        if self._depth_of(path) < self.depth:
+            entries.extend(
+                {"name": f"d{i}", "type": "dir", "size": 0, "last_modified": "2020-01-01 00:00:00+00:00"}
+                for i in range(self.dirs_per_level)
+            )
+        return entries
+
+    def _walk_files(self, path):
+        """Yield every file below a path"""
+        stack = [(path, self._depth_of(path))]
+        while stack:
+            current, depth = stack.pop()
+            for i in range(self.files_per_dir):
+                yield f"{current}/f{i}.dat"
+            if depth < self.depth:
+                stack.extend((f"{current}/d{i}", depth + 1) for i in range(self.dirs_per_level))
+
+    def _count_files(self, path):
+        """Number of files below a path"""
+        levels = max(0, self.depth - self._depth_of(path))
+        return self.files_per_dir * sum(self.dirs_per_level ** level for level in range(levels + 1))
+
+    def _new_task(self, task_type, data, items):
+        """Create a task"""
+        failed = self._chance(self.failure_rate)
+        active = self.polls_to_complete > 0
+        files = 0
+        for item in items:
+            if item.get("recursive"):
+                files += self._count_files(item["source_path"] if task_type == "TRANSFER" else item["path"])
+            else:
+                files += 1
+        task_id = str(uuid.uuid4())
+        now = self._now()
+        task = FakeResponse(
+            task_id=task_id,
+            type=task_type,
+            label=data.get("label"),
+            status="ACTIVE" if active else "FAILED" if failed else "SUCCEEDED",
+            is_ok=None,
+            request_time=now,
+            completion_time=None if active else now,
+            deadline=data.get("deadline"),
+            sync_level=data.get("sync_level"),
+            source_endpoint_id=data.get("source_endpoint", data.get("endpoint")),
+            destination_endpoint_id=data.get("destination_endpoint"),
+            source_endpoint_display_name="Fake source",
+            destination_endpoint_display_name="Fake destination",
+            directories=0,
+            files=files,
+            files_skipped=0,
+            files_transferred=0 if failed or active else files,
+            bytes_transferred=0 if failed or active else files * self.file_size,
+            bytes_checksummed=0,
+            subtasks_failed=1 if failed and not active else 0,
+        )
+        with self._lock:
+            self._tasks[task_id] = (task, items)
+            self._polls[task_id] = (self.polls_to_complete, failed, files)
+        return FakeResponse(task_id=task_id, code="Accepted")
+
+    def _poll(self, task_id):
+        """Return the task document, moving the task on by one status check"""
+        with self._lock:
+            task = self._tasks[task_id][0]
+            remaining, failed, files = self._polls[task_id]
+            if task["status"] == "ACTIVE":
+                remaining -= 1
+                self._polls[task_id] = (remaining, failed, files)
+                if remaining < 0:
+                    task["status"] = "FAILED" if failed else "SUCCEEDED"
+                    task["completion_time"] = self._now()
+                    if not failed:
+                        task["files_transferred"] = files
+                        task["bytes_transferred"] = files * self.file_size
+                    task["subtasks_failed"] = 1 if failed else 0
+            return task
+
+    def submitted_tasks(self):
+        """The documents of every task submitted so far, in order (not counted as a call)"""
+        with self._lock:
+            return [task for task, _ in self._tasks.values()]
+
+    def endpoint_autoactivate(self, endpoint_id, **kwargs):
+        self._call("endpoint_autoactivate")
+        code = "AutoActivationFailed" if self._chance(self.error_rate) else "AlreadyActivated"
+        return FakeResponse(code=code)
+
+    def operation_ls(self, endpoint_id, path=None, limit=None, offset=None, **kwargs):
+        self._call("operation_ls")
+        entries = self._entries(path or "/")
+        offset = offset or 0
+        limit = limit or 100000
+        return FakeResponse(DATA=entries[offset:offset + limit], path=path)
+
+    def get_submission_id(self, **kwargs):
+        self._call("get_submission_id")
+        return FakeResponse(value=str(uuid.uuid4()))
+
+    def submit_transfer(self, data):
+        self._call("submit_transfer")
+        return self._new_task("TRANSFER", data, list(data["DATA"]))
+
+    def submit_delete(self, data):
+        self._call("submit_delete")
+        return self._new_task("DELETE", data, list(data["DATA"]))
+
+    def get_task(self, task_id, **kwargs):
+        self._call("get_task")
+        return self._poll(task_id)
+
+    def cancel_task(self, task_id, **kwargs):
+        self._call("cancel_task")
+        task = self._tasks[task_id][0]
+        if task["status"] == "ACTIVE":
+            task["status"] = "FAILED"
+        return FakeResponse(code="Canceled")
+
+    def task_list(self, filter=None, limit=None, offset=None, **kwargs):
+        self._call("task_list")
+        task_ids = []
+        statuses = None
+        for clause in (filter or "").split("/"):
+            if clause.startswith("task_id:"):
+                task_ids = clause[len("task_id:"):].split(",")
+            elif clause.startswith("status:"):
+                statuses = clause[len("status:"):].split(",")
+        if statuses is not None:
+            # listing by status does not move the tasks on
+            tasks = [task for task, _ in self._tasks.values() if task["status"] in statuses]
+        else:
+            tasks = [self._poll(task_id) for task_id in task_ids if task_id in self._tasks]
+        offset = offset or 0
+        limit = limit or 1000
+        page = tasks[offset:offset + limit]
+        return FakeResponse(DATA=page, offset=offset, limit=limit, total=len(tasks))
+
+    def task_event_list(self, task_id, limit=None, offset=None, **kwargs):
+        self._call("task_event_list")
+        task = self._tasks[task_id][0]
+        events = []
+        if task["status"] == "FAILED":
+            # more than a page of progress events before the errors
+            events = [
+                {"time": task["completion_time"], "DATA_TYPE": "event", "code": "PROGRESS", "is_error": False,
+                 "description": "progress", "details": f"simulated progress {i}"}
+                for i in range(15)
+            ] + [
+                {"time": task["completion_time"], "DATA_TYPE": "event", "code": "PERMISSION_DENIED", "is_error": True,
+                 "description": "permission denied", "details": f"simulated failure {i}"}
+                for i in range(10)
+            ]
+        offset = offset or 0
+        limit = limit or 10
+        page = events[offset:offset + limit]
+        return FakeResponse(DATA=page, offset=offset, limit=limit, total=len(events))
+
+    def task_successful_transfers(self, task_id, marker=None, **kwargs):
+        self._call("task_successful_transfers")
+        task, items = self._tasks[task_id]
+        page_size = 1000
+        start = int(marker or 0)
+
+        def paths():
+            for item in items:
+                if item.get("recursive"):
+                    for src in self._walk_files(item["source_path"]):
+                        yield src, item["destination_path"] + src[len(item["source_path"]):]
+                else:
+                    yield item["source_path"], item["destination_path"]
+
+        # fetch one extra entry to know whether there is another page
+        page = [
+            {"DATA_TYPE": "successful_transfer", "source_path": src, "destination_path": dst}
+            for src, dst in itertools.islice(paths(), start, start + page_size + 1)
+        ]
+        next_marker = str(start + page_size) if len(page) > page_size else None
+        return FakeResponse(DATA=page[:page_size], next_marker=next_marker)
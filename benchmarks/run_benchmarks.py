@@ -0,0 +1,212 @@
+"""
+Offline benchmarks of Syncer against a simulated Globus Transfer service.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --scenario sections_100 --latency 0.05
+
+With --check, the behaviour checks in CHECKS are run instead; they simulate
+separate (cron) runs against the same state, each with a new Syncer.
+
+"""
+import sys
+import json
+import time
+import logging
+import datetime
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+from globus_sync_directory.syncer import Syncer
+
+from .fake_transfer import FakeTransferClient
+
+
+# name: (number of sections, section options, fake client options)
+SCENARIOS = {
+    "sections_10": (10, {}, {}),
+    "sections_100": (100, {}, {}),
+    "sections_1000": (1000, {}, {}),
+    "deep_tree_delete": (10, {"delete": "true"}, {"depth": 5, "dirs_per_level": 3, "files_per_dir": 20}),
+    "manifest_shard": (10, {"manifest": "true", "shard": "4"}, {"depth": 3, "dirs_per_level": 4, "files_per_dir": 10}),
+    "failed_tasks": (50, {}, {"failure_rate": 1.0}),
+    "active_tasks": (100, {}, {"polls_to_complete": 2}),
+}
+
+
+def write_config(path, num_sections, section_options, rate_limit=0, num_src_endpoints=5, num_dst_endpoints=3):
+    """Write a config file with the given number of sections spread over a few endpoints"""
+    lines = [
+        "[globus]",
+        "clientid = benchmark-client-id",
+        "",
+        "[concurrency]",
+        f"rate_limit = {rate_limit}",
+        "",
+    ]
+    for i in range(num_sections):
+        lines.extend([
+            f"[section{i:04d}]",
+            f"src_endpoint = src-endpoint-{i % num_src_endpoints}",
+            f"dst_endpoint = dst-endpoint-{i % num_dst_endpoints}",
+            f"src_path = /data/section{i:04d}",
+        ])
+        lines.extend(f"{key} = {value}" for key, value in section_options.items())
+        lines.append("")
+    with open(path, "w") as fh:
+        fh.write("\n".join(lines))
+
+
+def run_scenario(name, client_options, runs=3, rate_limit=0):
+    """Run one scenario and return its report"""
+    num_sections, section_options, scenario_client_options = SCENARIOS[name]
+    tc = FakeTransferClient(**{**scenario_client_options, **client_options})
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config_file = Path(tmpdir) / "config.ini"
+        cache_file = Path(tmpdir) / "cache.json"
+        write_config(config_file, num_sections, section_options, rate_limit=rate_limit)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        syncer = Syncer(config_file, None, cache_file, transfer_client=tc)
+        for _ in range(runs):
+            syncer.process(start=True)
+        wall_time = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "scenario": name,
+        "sections": num_sections,
+        "runs": runs,
+        "wall_time_seconds": round(wall_time, 3),
+        "api_calls": sum(tc.calls.values()),
+        "api_calls_by_method": dict(sorted(tc.calls.items())),
+        "peak_memory_mb": round(peak_memory / 1024 ** 2, 2),
+    }
+
+
+def run_syncers(tmpdir, tc, runs, num_sections, section_options):
+    """Process the sections `runs` times, each time with a new Syncer, as separate runs from cron would"""
+    config_file = Path(tmpdir) / "config.ini"
+    cache_file = Path(tmpdir) / "cache.json"
+    write_config(config_file, num_sections, section_options)
+    for _ in range(runs):
+        syncer = Syncer(config_file, None, cache_file, transfer_client=tc)
+        try:
+            syncer.process(start=True)
+        finally:
+            syncer.close()
+
+
+def check_local_changes_across_runs(tmpdir):
+    """An unchanged local source is not synced again once a transfer that finished in a later run succeeded"""
+    local_path = Path(tmpdir) / "local"
+    (local_path / "sub").mkdir(parents=True)
+    (local_path / "sub" / "file.dat").write_text("data")
+    tc = FakeTransferClient(polls_to_complete=1)
+    run_syncers(tmpdir, tc, 5, 3, {"local_path": local_path, "settle_secs": 0, "watcher": "poll"})
+    assert tc.calls["submit_transfer"] == 3, f"expected 3 transfers, got {tc.calls['submit_transfer']}"
+
+
+def check_failure_events_across_pages(tmpdir):
+    """The errors of a failed task are reported even when they come after the first page of events"""
+    records = []
+    handler = logging.Handler(logging.WARNING)
+    handler.emit = records.append
+    logger = logging.getLogger("section0000")
+    logger.addHandler(handler)
+    logger.setLevel(logging.WARNING)
+    logger.propagate = False
+    try:
+        run_syncers(tmpdir, FakeTransferClient(failure_rate=1.0), 1, 1, {})
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+        logger.propagate = True
+    errors = [record for record in records if "PERMISSION_DENIED" in record.getMessage()]
+    assert len(errors) == 2, f"expected 2 reported errors, got {len(errors)}"
+
+
+def check_checksum_deadline(tmpdir):
+    """A transfer escalated to checksum is not given a deadline predicted from the faster mtime transfers"""
+    tc = FakeTransferClient(polls_to_complete=1)
+    run_syncers(tmpdir, tc, 3, 1, {"adaptive_deadline": "true", "checksum_every_runs": 3})
+    allowed = [
+        (task["sync_level"], (datetime.datetime.fromisoformat(task["deadline"]).replace(tzinfo=datetime.timezone.utc)
+                              - datetime.datetime.fromisoformat(task["request_time"])).total_seconds())
+        for task in tc.submitted_tasks()
+    ]
+    # as submitted to the Transfer API, 2 is mtime and 3 checksum
+    levels = [level for level, _ in allowed]
+    assert levels == [2, 2, 3], f"expected two mtime transfers and a checksum one, got {levels}"
+    assert allowed[1][1] < 3600, f"expected the second mtime transfer to get an adaptive deadline, got {allowed[1][1]:.0f}s"
+    assert allowed[2][1] > 86000, f"expected the checksum transfer to get the full time limit, got {allowed[2][1]:.0f}s"
+
+
+# name: check, raising AssertionError if the behaviour is wrong
+CHECKS = {
+    "local_changes_across_runs": check_local_changes_across_runs,
+    "failure_events_across_pages": check_failure_events_across_pages,
+    "checksum_deadline": check_checksum_deadline,
+}
+
+
+def run_checks(names):
+    """Run the behaviour checks, returning whether they all passed"""
+    passed = True
+    for name in names:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            try:
+                CHECKS[name](tmpdir)
+            except AssertionError as exc:
+                passed = False
+                print(f"{name:>30}: FAILED {exc}")
+            else:
+                print(f"{name:>30}: ok")
+    return passed
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Benchmark globus_sync_directory against a simulated Globus service")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run (default=all, can be repeated)")
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="Simulated latency of every API call in seconds (default=0)")
+    parser.add_argument("-e", "--error-rate", type=float, default=0.0, help="Probability that an endpoint fails to activate (default=0)")
+    parser.add_argument("-f", "--failure-rate", type=float, default=None, help="Probability that a task fails (default=per scenario)")
+    parser.add_argument("--rate-limit", type=float, default=0, help="Syncer API rate limit in calls per second (default=0, unlimited)")
+    parser.add_argument("-r", "--runs", type=int, default=3, help="Number of Syncer.process runs per scenario (default=3)")
+    parser.add_argument("--check", action="store_true", help="Run the behaviour checks instead of the benchmarks")
+    parser.add_argument("-o", "--output", type=Path, help="Also write the reports to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.ERROR, format="[%(asctime)s] %(name)s %(levelname)s: %(message)s")
+
+    if args.check:
+        sys.exit(0 if run_checks(CHECKS) else 1)
+
+    client_options = {"latency": args.latency, "error_rate": args.error_rate}
+    if args.failure_rate is not None:
+        client_options["failure_rate"] = args.failure_rate
+
+    reports = []
+    for name in args.scenario or SCENARIOS:
+        report = run_scenario(name, client_options, runs=args.runs, rate_limit=args.rate_limit)
+        reports.append(report)
+        print(f"{name:>18}: {report['wall_time_seconds']:8.3f} s  {report['api_calls']:7d} calls  "
+              f"{report['peak_memory_mb']:8.2f} MB peak  {report['api_calls_by_method']}")
+
+    if args.output is not None:
+        with open(args.output, "w") as fh:
+            json.dump(reports, fh, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,17 @@
 Sync directories between Globus shared collections.
 
 """
+import sys
+import cProfile
 import argparse
 from pathlib import Path
 import logging
 
-from .syncer import Syncer
+# the modules that talk to Globus are imported when needed, so --status does not have to load globus_sdk
+from .fleet import find_config_files, namespaced_cache_file
+from .state import STATE_BACKENDS
+from .status import OfflineStatus
+from . import trace
 
 
 def parse_args():
@@ -15,10 +21,23 @@ def parse_args():
 
     parser = argparse.ArgumentParser(description="Sync directories with Globus")
 
-    parser.add_argument("-c", "--config-file", default="config.ini", type=Path, help="Path to config file (default=config.ini)")
+    parser.add_argument("-c", "--config-file", default=[Path("config.ini")], type=Path, nargs="+",
+                        help="Path to config file (default=config.ini); several files, or directories of *.ini files, are run together in one process")
     parser.add_argument("-s", "--secret-file", default=default_secret_file, type=Path, help=f"Path to secret file (default={default_secret_file})")
-    parser.add_argument("-t", "--cache-file", default="globus_sync_directory.json", type=Path, help="Path to cache file (default=globus_sync_directory.json)")
+    parser.add_argument("-t", "--cache-file", default="globus_sync_directory.json", type=Path,
+                        help="Path to cache file (default=globus_sync_directory.json); with several config files, each gets its own cache file named after the config file")
+    parser.add_argument("-b", "--state-backend", default="json", choices=STATE_BACKENDS,
+                        help="Where to keep the transfer state: the JSON cache file, or a SQLite database with task history next to it (default=json)")
     parser.add_argument("-d", "--dont-start", action="store_true", help="Do not start a transfer")
+    parser.add_argument("--status", action="store_true",
+                        help="Print the status of the current tasks from the cache, only asking Globus about sections whose cached status is too old")
+    parser.add_argument("--max-age", type=float, default=None,
+                        help="With --status, the age in minutes after which the cached status of an active task is refreshed (default from the config file, or 10)")
+    parser.add_argument("--plan", action="store_true", help="Compare the source and destination of each section and report what a new sync would transfer, without starting anything")
+    parser.add_argument("--daemon", action="store_true", help="Keep running, polling the tasks and starting new syncs when they are due (see the [daemon] config section)")
+    parser.add_argument("--trace", type=Path, default=None,
+                        help="Write timed spans of each phase and Globus call to this file, as Chrome trace-event JSON (open in chrome://tracing or ui.perfetto.dev)")
+    parser.add_argument("--profile", type=Path, default=None, help="Write cProfile stats for the whole run to this file (read them with python -m pstats)")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
     parser.add_argument("-q", "--quiet", action="store_true", help="Only display warnings or errors")
 
@@ -27,6 +46,24 @@ def parse_args():
     return args
 
 
+def cached_status(args, config_files, fleet):
+    """Status of every config from the cached task snapshots, refreshing only the stale sections from Globus"""
+    output = []
+    for config_file in config_files:
+        cache_file = namespaced_cache_file(args.cache_file, config_file) if fleet else args.cache_file
+        max_age = None if args.max_age is None else 60 * args.max_age
+        lines, stale = OfflineStatus(config_file, cache_file, state_backend=args.state_backend, max_age=max_age).report()
+        output.extend(lines)
+        if stale:
+            from .syncer import Syncer
+            s = Syncer(config_file, args.secret_file, cache_file, state_backend=args.state_backend, sections=stale)
+            try:
+                output.extend(s.process(start=False, notify=False))
+            finally:
+                s.close()
+    return output
+
+
 def main():
     # get command line args
     args = parse_args()
@@ -48,11 +85,66 @@ def main():
     print()
     logging.info("Running globus_sync_directory...")
 
+    # optionally, trace and/or profile the run
+    tracer = trace.enable() if args.trace is not None else None
+    profiler = cProfile.Profile() if args.profile is not None else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logging.info(f"Wrote profile to {args.profile}")
+        if tracer is not None:
+            tracer.write(args.trace)
+
+
+def run(args):
+    """Run the mode selected on the command line"""
+    config_files = find_config_files(args.config_file)
+    if not config_files:
+        raise ValueError(f"No config files found in: {', '.join(str(path) for path in args.config_file)}")
+    fleet = len(config_files) > 1 or args.config_file[0].is_dir()
+
+    # keep running until stopped
+    if args.daemon:
+        if args.plan:
+            raise ValueError("--daemon and --plan cannot be used together")
+        if args.dont_start:
+            raise ValueError("--daemon and --dont-start cannot be used together")
+        if fleet:
+            raise ValueError("--daemon only supports a single config file")
+        from .daemon import Daemon
+        Daemon(config_files[0], args.secret_file, args.cache_file, state_backend=args.state_backend).run()
+        return
+
+    # fast status from the cache
+    if args.status:
+        print("\n".join(cached_status(args, config_files, fleet)))
+        return
+
+    # several configs in one process, with a combined summary and exit status
+    if fleet:
+        from .fleet import Fleet
+        f = Fleet(config_files, args.secret_file, args.cache_file, state_backend=args.state_backend)
+        output, status = f.plan() if args.plan else f.process(start=(not args.dont_start))
+        print("\n".join(output))
+        sys.exit(status)
+
     # create the directory syncer
-    s = Syncer(args.config_file, args.secret_file, args.cache_file)
+    from .syncer import Syncer
+    s = Syncer(config_files[0], args.secret_file, args.cache_file, state_backend=args.state_backend)
 
     # process the transfers
-    s.process(start=(not args.dont_start))
+    try:
+        if args.plan:
+            print("\n".join(s.plan()))
+        else:
+            s.process(start=(not args.dont_start))
+    finally:
+        s.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+import time
+import random
+import logging
+import functools
+import threading
+
+import globus_sdk
+
+
+# HTTP statuses worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# calls that can safely be repeated; submissions are made idempotent with their submission_id
+RETRY_METHODS = (
+    "endpoint_autoactivate",
+    "operation_ls",
+    "get_submission_id",
+    "get_task",
+    "task_list",
+    "task_event_list",
+    "task_successful_transfers",
+    "cancel_task",
+    "submit_transfer",
+    "submit_delete",
+)
+SUBMIT_METHODS = ("submit_transfer", "submit_delete")
+DEFAULT_RATE_LIMIT = 20.0
+DEFAULT_BURST = 20
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 60.0
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter shared by all threads
+
+    A rate of 0 means unlimited.
+
+    """
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call is allowed"""
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+def retry_after(exc):
+    """Seconds the server asked us to wait before retrying (the Retry-After header), or None"""
+    headers = getattr(exc, "headers", None) or {}
+    try:
+        return max(0.0, float(headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        # missing, or given as an HTTP date
+        return None
+
+
+def is_retryable(exc):
+    """Whether an exception from the Globus SDK is transient"""
+    if isinstance(exc, globus_sdk.NetworkError):
+        return True
+    if isinstance(exc, globus_sdk.GlobusAPIError):
+        return exc.http_status in RETRY_STATUSES
+    return False
+
+
+class ResilientClient:
+    """
+    Proxy for a transfer client that rate limits every call and retries transient errors
+
+    Retries use exponential backoff with full jitter, but never wait less than
+    the server's Retry-After. The wrapped client must not retry by itself (see
+    Syncer._authenticate), so that every attempt is rate limited and counted.
+    Submissions always carry a submission_id, so Globus treats a repeated
+    submission as the same task.
+
+    """
+    def __init__(self, client, metrics=None, rate_limit=DEFAULT_RATE_LIMIT, burst=DEFAULT_BURST,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX):
+        self._logger = logging.getLogger("ResilientClient")
+        self._client = client
+        self._metrics = metrics
+        self._bucket = TokenBucket(rate_limit, burst)
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+
+    def _backoff(self, attempt, exc=None):
+        """Delay before the given retry"""
+        delay = random.uniform(0, min(self._backoff_max, self._backoff_base * 2 ** attempt))
+        requested = retry_after(exc) if exc is not None else None
+        return delay if requested is None else max(delay, requested)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            if name in SUBMIT_METHODS and args and not args[0].get("submission_id"):
+                args[0]["submission_id"] = self.get_submission_id()["value"]
+
+            attempt = 0
+            while True:
+                self._bucket.acquire()
+                try:
+                    return attr(*args, **kwargs)
+                except Exception as exc:
+                    if name not in RETRY_METHODS or attempt >= self._max_retries or not is_retryable(exc):
+                        raise
+                    delay = self._backoff(attempt, exc)
+                    status = getattr(exc, "http_status", None)
+                    reason = exc.__class__.__name__ if status is None else f"{exc.__class__.__name__} {status}"
+                    self._logger.warning(f"{name} failed ({reason}), retry {attempt + 1}/{self._max_retries} in {delay:.1f}s")
+                    if self._metrics is not None:
+                        self._metrics.observe_retry(name, delay)
+                    time.sleep(delay)
+                    attempt += 1
+
+        return call
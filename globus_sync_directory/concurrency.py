@@ -0,0 +1,75 @@
+import threading
+import contextlib
+import concurrent.futures
+
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_PER_ENDPOINT = 2
+
+
+class CallCache:
+    """
+    Memoise the results of transfer client calls for the duration of a run
+
+    Concurrent callers asking for the same call share a single request, and
+    any exception raised by it is re-raised to every caller.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def call(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs), or return the result of an earlier identical call"""
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._futures[key] = future
+
+        if owner:
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as exc:
+                future.set_exception(exc)
+
+        return future.result()
+
+
+class EndpointLimiter:
+    """
+    Cap the number of transfers in flight per source and per destination endpoint
+
+    A limit of 0 means unlimited.
+
+    """
+    def __init__(self, max_per_src_endpoint=0, max_per_dst_endpoint=0):
+        self._max_per_src = max_per_src_endpoint
+        self._max_per_dst = max_per_dst_endpoint
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _semaphore(self, role, endpoint, limit):
+        """Return the semaphore for an endpoint, creating it if required"""
+        with self._lock:
+            key = (role, endpoint)
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(limit)
+            return self._semaphores[key]
+
+    @contextlib.contextmanager
+    def limit(self, src_endpoint, dst_endpoint):
+        """Hold a slot on both endpoints for the duration of the context"""
+        # always acquire the source slot before the destination slot so there can be no lock cycles
+        semaphores = []
+        if self._max_per_src > 0:
+            semaphores.append(self._semaphore("src", src_endpoint, self._max_per_src))
+        if self._max_per_dst > 0:
+            semaphores.append(self._semaphore("dst", dst_endpoint, self._max_per_dst))
+
+        with contextlib.ExitStack() as stack:
+            for semaphore in semaphores:
+                stack.enter_context(semaphore)
+            yield
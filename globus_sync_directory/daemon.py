@@ -0,0 +1,126 @@
+import signal
+import logging
+import threading
+import configparser
+
+from .syncer import Syncer
+from .state import lease_owner
+
+
+DEFAULT_MIN_INTERVAL_MINS = 60
+DEFAULT_POLL_MIN_SECS = 30
+DEFAULT_POLL_MAX_SECS = 900
+
+
+class Daemon:
+    """
+    Keep a Syncer alive, polling the tasks and starting new syncs as soon as they are due
+
+    The poll interval adapts to what the tasks are doing: it drops to the
+    minimum while bytes are moving and doubles (up to the maximum) while
+    tasks are queued or not making progress. When nothing is running the
+    daemon sleeps until the next sync is due. The config file is reloaded
+    when it changes and SIGTERM/SIGINT stop the daemon after the current pass.
+
+    """
+    def __init__(self, config_file, secret_file, cache_file, state_backend="json"):
+        self._logger = logging.getLogger("Daemon")
+        self._config_file = config_file
+        self._secret_file = secret_file
+        self._cache_file = cache_file
+        self._state_backend = state_backend
+        self._stop = threading.Event()
+        self._syncer = None
+        self._config_mtime = None
+        # the sections stay leased to the daemon across config reloads
+        self._lease_owner = lease_owner()
+
+    def _read_settings(self):
+        """Read the [daemon] section of the config file"""
+        config = configparser.ConfigParser()
+        config.read(self._config_file)
+        self._min_interval = 60 * config.getfloat("daemon", "min_interval_mins", fallback=DEFAULT_MIN_INTERVAL_MINS)
+        self._poll_min = config.getfloat("daemon", "poll_min_secs", fallback=DEFAULT_POLL_MIN_SECS)
+        self._poll_max = config.getfloat("daemon", "poll_max_secs", fallback=DEFAULT_POLL_MAX_SECS)
+        if self._poll_min <= 0 or self._poll_max < self._poll_min:
+            raise ValueError("[daemon] poll_min_secs must be positive and no larger than poll_max_secs")
+        self._logger.info(f"Minimum interval between syncs: {self._min_interval}s, polling every {self._poll_min}-{self._poll_max}s")
+        return config.get("globus", "clientid", fallback=None)
+
+    def _load(self):
+        """Create (or recreate) the syncer from the config file"""
+        self._config_mtime = self._config_file.stat().st_mtime
+        client_id = self._read_settings()
+
+        # keep the authenticated client unless the app itself changed
+        transfer_client = None
+        if self._syncer is not None and self._syncer.client_id == client_id:
+            transfer_client = self._syncer.transfer_client
+
+        syncer = Syncer(self._config_file, self._secret_file, self._cache_file,
+                        state_backend=self._state_backend, transfer_client=transfer_client, long_running=True,
+                        lease_owner=self._lease_owner)
+        if self._syncer is not None:
+            self._syncer.close(keep_leases=syncer.section_names)
+        self._syncer = syncer
+
+    def _reload_if_changed(self):
+        """Reload the config file if it has been modified, keeping the old one if the new one is broken"""
+        try:
+            mtime = self._config_file.stat().st_mtime
+        except OSError as exc:
+            self._logger.error(f"Cannot stat config file, keeping the current config: {exc}")
+            return
+        if mtime != self._config_mtime:
+            self._logger.info(f"Config file {self._config_file} changed, reloading")
+            try:
+                self._load()
+            except Exception:
+                self._config_mtime = mtime
+                self._logger.exception("Failed to reload the config file, keeping the current config")
+
+    def stop(self, signum=None, frame=None):
+        """Stop after the current pass"""
+        self._logger.info(f"Stopping (signal {signum})")
+        self._stop.set()
+
+    def run(self):
+        """Run until stopped"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self._load()
+        interval = self._poll_min
+        previous_bytes = None
+        while not self._stop.is_set():
+            self._reload_if_changed()
+
+            try:
+                self._syncer.process(start=True, min_interval=self._min_interval, notify_on_events_only=True)
+            except Exception:
+                # a failed pass (e.g. Globus being down) should not kill the daemon
+                self._logger.exception("Processing failed, will retry")
+                interval = min(self._poll_max, interval * 2)
+                self._stop.wait(interval)
+                continue
+
+            busy, active_bytes, next_due = self._syncer.get_activity(self._min_interval)
+            if busy:
+                if previous_bytes is not None and active_bytes != previous_bytes:
+                    # bytes are moving, keep a close eye on it
+                    interval = self._poll_min
+                else:
+                    # queued, paused or not making progress, back off
+                    interval = min(self._poll_max, interval * 2)
+                previous_bytes = active_bytes
+            else:
+                # nothing running, wake up when the next sync is due
+                previous_bytes = None
+                wait = self._poll_max if next_due is None else next_due
+                interval = min(self._poll_max, max(self._poll_min, wait))
+
+            self._logger.info(f"{busy} transfers busy ({active_bytes} bytes so far), next poll in {interval:.0f}s")
+            self._stop.wait(interval)
+
+        self._syncer.close()
+        self._logger.info("Stopped")
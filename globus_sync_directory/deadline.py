@@ -0,0 +1,66 @@
+import datetime
+
+
+DEFAULT_DEADLINE_MARGIN = 2.0
+DEFAULT_MIN_DEADLINE_MINS = 30
+
+
+def format_seconds(seconds):
+    """Human readable duration, to the second"""
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+class DeadlinePolicy:
+    """
+    Choose the deadline of each new transfer of a section
+
+    The next transfer is predicted to move as much data as the largest of the
+    recent successful transfers at the same sync level, at their combined
+    effective throughput (without any, it gets the global limit). With
+    `adaptive` set, it is given `margin` times the predicted duration, but at
+    least `min_mins` minutes and never more than the global `limit_mins`;
+    otherwise every transfer gets the global limit. The prediction is made
+    either way, so its accuracy can be checked before relying on it.
+
+    """
+    def __init__(self, limit_mins, adaptive=False, margin=DEFAULT_DEADLINE_MARGIN, min_mins=DEFAULT_MIN_DEADLINE_MINS):
+        self._limit_mins = limit_mins
+        self.adaptive = adaptive
+        self.margin = margin
+        self._min_mins = min_mins
+
+    def __repr__(self):
+        if not self.adaptive:
+            return f"{self._limit_mins} mins"
+        return f"adaptive ({self.margin}x predicted, {self._min_mins} to {self._limit_mins} mins)"
+
+    def predict(self, history, sync_level):
+        """
+        Predict the next transfer from the [bytes, seconds, sync_level] history of the recent successful ones
+
+        Only transfers at the same sync level count, a checksum pass over the whole tree takes far longer than
+        an mtime sync of the changes. Transfers recorded without a level count for any level but checksum.
+        Returns a dict with the predicted bytes and seconds, or None without any history at the level.
+
+        """
+        history = [entry[:2] for entry in history
+                   if (entry[2] == sync_level if len(entry) > 2 else sync_level != "checksum")]
+        if not history:
+            return None
+        total_bytes = sum(b for b, _ in history)
+        total_seconds = sum(s for _, s in history)
+        if not total_bytes or not total_seconds:
+            return None
+        volume = max(b for b, _ in history)
+        return {"bytes": volume, "seconds": volume * total_seconds / total_bytes}
+
+    def allowed_seconds(self, prediction):
+        """Seconds a transfer with this prediction (or None) is given before its deadline"""
+        limit = 60 * self._limit_mins
+        if not self.adaptive or prediction is None:
+            return limit
+        return min(limit, max(60 * self._min_mins, self.margin * prediction["seconds"]))
+
+    def deadline(self, prediction, now):
+        """Deadline (in UTC, as given to the Transfer service) for a transfer submitted at `now`"""
+        return str(datetime.datetime.utcfromtimestamp(now + self.allowed_seconds(prediction)))
@@ -1,6 +1,8 @@
 import logging
 import subprocess
 
+from . import trace
+
 
 def send_email(email_list, subject, message):
     """
@@ -13,7 +15,8 @@ def send_email(email_list, subject, message):
     cmdargs.extend(email_list)
     cmd = " ".join(cmdargs)
     logger.debug(f"email command: {cmd}")
-    status = subprocess.run(cmd, shell=True, universal_newlines=True, input=message)
+    with trace.span("email.send_email", recipients=",".join(email_list)):
+        status = subprocess.run(cmd, shell=True, universal_newlines=True, input=message)
     if status.returncode:
         logger.warning("Warning: sending email failed")
         logger.warning(cmd)
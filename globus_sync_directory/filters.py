@@ -0,0 +1,68 @@
+import fnmatch
+import posixpath
+
+
+def parse_patterns(value):
+    """Split a config value into glob patterns (whitespace or comma separated)"""
+    if not value:
+        return []
+    return [pattern for pattern in value.replace(",", " ").split() if pattern]
+
+
+class PathFilter:
+    """
+    Include/exclude glob patterns for the items of a transfer
+
+    The patterns are matched against item names, like Globus filter rules.
+    Include patterns win over exclude patterns; if only include patterns are
+    given, every other file is excluded. An excluded directory excludes
+    everything below it.
+
+    """
+    def __init__(self, include=(), exclude=()):
+        self._include = list(include)
+        self._exclude = list(exclude)
+        # rules are (method, pattern, type) and the first matching rule applies
+        self._rules = [("include", pattern, None) for pattern in self._include]
+        self._rules.extend(("exclude", pattern, None) for pattern in self._exclude)
+        if self._include and not self._exclude:
+            self._rules.append(("exclude", "*", "file"))
+
+    def __bool__(self):
+        return bool(self._rules)
+
+    def __repr__(self):
+        return f"include={self._include}, exclude={self._exclude}"
+
+    def add_rules(self, tdata):
+        """Add the rules to a TransferData document"""
+        for method, pattern, item_type in self._rules:
+            tdata.add_filter_rule(pattern, method=method, type=item_type)
+
+    def _name_included(self, name, item_type):
+        """Whether a single item name passes the rules"""
+        for method, pattern, rule_type in self._rules:
+            if rule_type is not None and rule_type != item_type:
+                continue
+            if fnmatch.fnmatchcase(name, pattern):
+                return method == "include"
+        return True
+
+    def included(self, rel, is_dir=False):
+        """Whether a path relative to the root of the transfer is transferred"""
+        if not self._rules:
+            return True
+        parts = [part for part in rel.split("/") if part]
+        if not parts:
+            return True
+        for part in parts[:-1]:
+            if not self._name_included(part, "dir"):
+                return False
+        return self._name_included(parts[-1], "dir" if is_dir else "file")
+
+    def included_path(self, root, path, is_dir=False):
+        """Whether an absolute path below root is transferred"""
+        if not self._rules:
+            return True
+        rel = posixpath.relpath(path, root)
+        return rel == "." or self.included(rel, is_dir)
@@ -0,0 +1,130 @@
+import logging
+from pathlib import Path
+
+from .concurrency import CallCache
+
+
+def find_config_files(paths):
+    """Expand the given config files and directories (every *.ini file in them) into a list of config files"""
+    config_files = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            config_files.extend(sorted(path.glob("*.ini")))
+        else:
+            config_files.append(path)
+    return config_files
+
+
+def namespaced_cache_file(cache_file, config_file):
+    """Cache file of a single config in a fleet, e.g. cache.json -> cache.groupA.json"""
+    cache_file = Path(cache_file)
+    return cache_file.with_name(f"{cache_file.stem}.{Path(config_file).stem}{cache_file.suffix}")
+
+
+class Fleet:
+    """
+    Run several config files in one process
+
+    Each config keeps its own cache file (named after the config file),
+    notification settings and metrics. Configs with the same clientid share
+    one authenticated TransferClient, and with it the HTTP connection pool
+    and the results of the endpoint checks.
+
+    """
+    def __init__(self, config_files, secret_file, cache_file, state_backend="json"):
+        self._logger = logging.getLogger("Fleet")
+        self._config_files = list(config_files)
+        self._secret_file = secret_file
+        self._cache_file = cache_file
+        self._state_backend = state_backend
+        self._syncers = {}
+        self._errors = {}
+
+        names = [Path(config_file).stem for config_file in self._config_files]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Config file names must be unique, their cache files would clash: {', '.join(duplicates)}")
+
+    def _load(self):
+        """Create a syncer per config file, sharing the transfer client between configs with the same clientid"""
+        # imported here so finding the config files does not load globus_sdk
+        from .syncer import Syncer
+
+        clients = {}
+        call_caches = {}
+        for config_file in self._config_files:
+            try:
+                client_id = Syncer.read_client_id(config_file)
+                syncer = Syncer(config_file, self._secret_file, namespaced_cache_file(self._cache_file, config_file),
+                                state_backend=self._state_backend, transfer_client=clients.get(client_id),
+                                call_cache=call_caches.setdefault(client_id, CallCache()))
+            except Exception as exc:
+                # one broken config should not stop the others
+                self._logger.exception(f"Failed to load {config_file}")
+                self._errors[config_file] = exc
+                continue
+            clients.setdefault(client_id, syncer.transfer_client)
+            self._syncers[config_file] = syncer
+        self._logger.info(f"Loaded {len(self._syncers)} of {len(self._config_files)} configs "
+                          f"using {len(clients)} transfer clients")
+
+    def _run(self, name, func):
+        """Call func on each syncer, recording (instead of raising) errors"""
+        results = {}
+        for config_file, syncer in self._syncers.items():
+            self._logger.info(f"{name}: {config_file}")
+            try:
+                results[config_file] = func(syncer)
+            except Exception as exc:
+                self._logger.exception(f"{name} failed for {config_file}")
+                self._errors[config_file] = exc
+            finally:
+                syncer.close()
+        return results
+
+    def process(self, start=True):
+        """
+        Process every config and return the combined summary lines and exit status
+
+        The exit status is 1 if any config failed to load or run, or any task failed.
+
+        """
+        self._load()
+
+        def process(syncer):
+            syncer.process(start=start)
+            return syncer.summary()
+
+        summaries = self._run("Processing", process)
+
+        output = ["Run summary:"]
+        totals = {"sections": 0, "busy": 0, "failed": 0}
+        for config_file in self._config_files:
+            if config_file in self._errors:
+                output.append(f"  {config_file}: ERROR: {self._errors[config_file]}")
+                continue
+            summary = summaries[config_file]
+            for key in totals:
+                totals[key] += summary[key]
+            output.append(f"  {config_file}: {summary['sections']} sections, {summary['busy']} busy, {summary['failed']} failed")
+        output.append(f"  total: {totals['sections']} sections, {totals['busy']} busy, {totals['failed']} failed, "
+                      f"{len(self._errors)} configs with errors")
+
+        status = 1 if self._errors or totals["failed"] else 0
+        return output, status
+
+    def plan(self):
+        """Plan every config, returning the combined report and exit status"""
+        self._load()
+        plans = self._run("Planning", lambda syncer: syncer.plan())
+
+        output = []
+        for config_file in self._config_files:
+            output.append(f"{config_file}:")
+            if config_file in self._errors:
+                output.append(f"  ERROR: {self._errors[config_file]}")
+            else:
+                output.extend(f"  {line}" for line in plans[config_file])
+
+        return output, 1 if self._errors else 0
@@ -0,0 +1,35 @@
+LS_PAGE_SIZE = 1000
+
+
+def iter_dir(tc, endpoint, path):
+    """
+    Yield the entries of a directory on an endpoint, one operation_ls page at a time
+
+    """
+    offset = 0
+    while True:
+        res = tc.operation_ls(endpoint, path=path, limit=LS_PAGE_SIZE, offset=offset)
+        page = res["DATA"]
+        yield from page
+        if len(page) < LS_PAGE_SIZE:
+            break
+        offset += len(page)
+
+
+def iter_paginated(method, *args, limit=100, **kwargs):
+    """
+    Yield the items of an offset paginated Transfer API call, one page at a time
+
+    Unlike TransferClient.paginated, every page goes through the given (possibly
+    wrapped) client method. The responses (task_list, task_event_list) give the
+    total number of items rather than whether there is another page.
+
+    """
+    offset = 0
+    while True:
+        res = method(*args, limit=limit, offset=offset, **kwargs)
+        page = res["DATA"]
+        yield from page
+        offset += len(page)
+        if not page or offset >= res.get("total", 0):
+            break
@@ -0,0 +1,165 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import posixpath
+import concurrent.futures
+from pathlib import Path
+
+from .listing import iter_dir
+
+
+# above this many changed subtrees we just sync the whole source path
+MAX_MANIFEST_ITEMS = 1000
+
+
+def _depth(rel):
+    """Depth of a path relative to the root of the manifest"""
+    return rel.count("/") + 1 if rel else 0
+
+
+class Manifest:
+    """
+    Index of the source tree of a transfer, used to skip unchanged subtrees
+
+    The file entries (path, size, mtime) are streamed to a JSON lines file as
+    the source is walked; only one fingerprint per directory is kept in memory.
+    Fingerprints of the tree being transferred are stored as "pending" and
+    promoted to "synced" once the transfer succeeds. Entries excluded by the
+    path filter are left out, so they never trigger a transfer.
+
+    """
+    def __init__(self, directory, name, workers, path_filter=None):
+        self._logger = logging.getLogger(name)
+        self._dir = Path(directory)
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+        self._manifest_path = self._dir / f"{safe_name}.manifest.jsonl"
+        self._pending_path = self._dir / f"{safe_name}.pending.json"
+        self._synced_path = self._dir / f"{safe_name}.synced.json"
+        self._workers = workers
+        self._path_filter = path_filter
+        self.filtered = {"files": 0, "directories": 0, "bytes": 0}
+
+    def _load(self, path):
+        """Load a fingerprints file, if it exists"""
+        if path.exists():
+            with open(path) as fh:
+                return json.load(fh)
+        return None
+
+    def _dump(self, path, data):
+        """Write a fingerprints file atomically"""
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as fh:
+            json.dump(data, fh)
+        os.replace(tmp_path, path)
+
+    def build(self, tc, endpoint, root):
+        """Walk the source with parallel listings and store the fingerprints as pending"""
+        self._logger.info(f"Building source manifest for {endpoint}:{root}")
+        self._dir.mkdir(parents=True, exist_ok=True)
+
+        def list_dir(rel):
+            return sorted(iter_dir(tc, endpoint, posixpath.join(root, rel)), key=lambda e: e["name"])
+
+        dirs = {}
+        count_files = 0
+        filtered = {"files": 0, "directories": 0, "bytes": 0}
+        tmp_manifest = self._manifest_path.with_name(self._manifest_path.name + ".tmp")
+        with open(tmp_manifest, "w") as fh, concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) as executor:
+            pending = {executor.submit(list_dir, ""): ""}
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    rel = pending.pop(future)
+                    own = hashlib.sha1()
+                    children = []
+                    for entry in future.result():
+                        child = posixpath.join(rel, entry["name"])
+                        if self._path_filter and not self._path_filter.included(child, entry["type"] == "dir"):
+                            if entry["type"] == "dir":
+                                filtered["directories"] += 1
+                            else:
+                                filtered["files"] += 1
+                                filtered["bytes"] += entry["size"]
+                            continue
+                        if entry["type"] == "dir":
+                            children.append(child)
+                            own.update(f"d {entry['name']}\n".encode())
+                            pending[executor.submit(list_dir, child)] = child
+                        else:
+                            own.update(f"f {entry['name']} {entry['size']} {entry['last_modified']}\n".encode())
+                            fh.write(json.dumps({"path": child, "size": entry["size"], "mtime": entry["last_modified"]}) + "\n")
+                            count_files += 1
+                    dirs[rel] = {"own": own.hexdigest(), "children": children}
+        os.replace(tmp_manifest, self._manifest_path)
+
+        # fingerprint each subtree bottom up from its own entries and its children's fingerprints
+        for rel in sorted(dirs, key=_depth, reverse=True):
+            tree = hashlib.sha1(dirs[rel]["own"].encode())
+            for child in dirs[rel]["children"]:
+                tree.update(dirs[child]["tree"].encode())
+            dirs[rel]["tree"] = tree.hexdigest()
+
+        self.filtered = filtered
+        self._logger.info(f"Source manifest has {len(dirs)} directories and {count_files} files")
+        if any(filtered.values()):
+            self._logger.info(f"Filtered out {filtered['files']} files ({filtered['bytes']} bytes) "
+                              f"and {filtered['directories']} directories")
+        self._dump(self._pending_path, dirs)
+
+        return dirs
+
+    def changed_paths(self, dirs):
+        """Return the smallest set of subtrees (relative paths) that differ from the last successful sync"""
+        synced = self._load(self._synced_path) or {}
+        changed = []
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            new = dirs[rel]
+            old = synced.get(rel)
+            if old is not None and old["tree"] == new["tree"]:
+                # nothing changed below here
+                continue
+            if old is None or old["own"] != new["own"]:
+                # files or directories were added, removed or modified here, sync the whole subtree
+                changed.append(rel)
+            else:
+                # only something further down changed
+                stack.extend(new["children"])
+
+        return sorted(changed)
+
+    def commit(self):
+        """The transfer succeeded, so the pending fingerprints become the synced ones"""
+        if self._pending_path.exists():
+            self._logger.debug("Committing source manifest")
+            os.replace(self._pending_path, self._synced_path)
+
+    def discard(self):
+        """The transfer failed or was not needed, forget the pending fingerprints"""
+        if self._pending_path.exists():
+            self._logger.debug("Discarding pending source manifest")
+            self._pending_path.unlink()
+
+    def subtree_sizes(self, rels):
+        """Total size of the files below each of the given relative paths, streamed from the manifest"""
+        sizes = {rel: 0 for rel in rels}
+        if not self._manifest_path.exists():
+            return sizes
+
+        with open(self._manifest_path) as fh:
+            for line in fh:
+                entry = json.loads(line)
+                path = entry["path"]
+                while True:
+                    if path in sizes:
+                        sizes[path] += entry["size"]
+                        break
+                    if not path:
+                        break
+                    path = posixpath.dirname(path)
+
+        return sizes
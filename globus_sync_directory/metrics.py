@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import bisect
+import datetime
+import functools
+import threading
+
+
+# upper bounds (seconds) of the API call latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TASK_METRIC_KEYS = ("bytes_transferred", "files_transferred", "files_skipped")
+# the status of a sync is that of its least finished (or failed) task
+STATUS_ORDER = ("FAILED", "ACTIVE", "INACTIVE", "SUCCEEDED")
+
+
+def parse_time(value):
+    """Parse a Globus timestamp, returning None if it is not set or not valid"""
+    if not value:
+        return None
+    try:
+        dt = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt
+
+
+def task_elapsed(task_info, now=None):
+    """Seconds between the request and completion (or now, if still running) of a task"""
+    start = parse_time(task_info.get("request_time"))
+    if start is None:
+        return None
+    end = parse_time(task_info.get("completion_time"))
+    if end is None:
+        end = now or datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (end - start).total_seconds())
+
+
+def _write_atomic(path, text):
+    """Write a file so that readers never see it half written"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as fh:
+        fh.write(text)
+    os.replace(tmp_path, path)
+
+
+def _escape(value):
+    """Escape a Prometheus label value"""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metrics:
+    """
+    Task and API call metrics collected during a run
+
+    Written out as a Prometheus textfile collector file and/or a JSON report.
+
+    """
+    def __init__(self, config_name):
+        self._lock = threading.Lock()
+        self._config_name = config_name
+        self._started = time.time()
+        self._tasks = {}
+        self._calls = {}
+        self._retries = {}
+        self._sections = {}
+
+    def observe_call(self, method, seconds, error=False):
+        """Record the latency of a single API call"""
+        with self._lock:
+            call = self._calls.setdefault(method, {
+                "count": 0, "errors": 0, "sum": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+            })
+            call["count"] += 1
+            call["sum"] += seconds
+            call["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            if error:
+                call["errors"] += 1
+
+    def observe_retry(self, method, backoff_seconds):
+        """Record a retried API call and how long we backed off for"""
+        with self._lock:
+            retry = self._retries.setdefault(method, {"count": 0, "backoff_seconds": 0.0})
+            retry["count"] += 1
+            retry["backoff_seconds"] += backoff_seconds
+
+    def record_section(self, section, **values):
+        """Record numeric per-section statistics"""
+        with self._lock:
+            self._sections.setdefault(section, {}).update(values)
+
+    def record_task(self, section, task_info, run=None):
+        """
+        Record the latest document of a task of a section
+
+        `run` identifies the sync the task belongs to (when it was started). The
+        tasks of the latest sync (its shards, destinations or deletion chunks)
+        are added up per section and task type; tasks of an older sync are
+        dropped once a newer one is seen.
+
+        """
+        metrics = {key: task_info.get(key) or 0 for key in TASK_METRIC_KEYS}
+        metrics.update({
+            "task_id": task_info.get("task_id"),
+            "type": task_info.get("type", "TRANSFER"),
+            "status": task_info.get("status"),
+            "request_time": task_info.get("request_time"),
+            "completion_time": task_info.get("completion_time"),
+            "elapsed_seconds": task_elapsed(task_info),
+        })
+        run = run or 0
+        with self._lock:
+            group = self._tasks.get((section, metrics["type"]))
+            if group is None or run > group["run"]:
+                group = self._tasks[(section, metrics["type"])] = {"run": run, "tasks": {}}
+            elif run < group["run"]:
+                return
+            group["tasks"][metrics["task_id"]] = metrics
+
+    @staticmethod
+    def _combine(tasks):
+        """Add up the tasks of a sync: total bytes and files, over the longest span"""
+        tasks = sorted(tasks.values(), key=lambda m: m["request_time"] or "")
+        combined = {key: sum(m[key] for m in tasks) for key in TASK_METRIC_KEYS}
+        statuses = [m["status"] for m in tasks]
+        elapsed = [m["elapsed_seconds"] for m in tasks if m["elapsed_seconds"] is not None]
+        completions = [m["completion_time"] for m in tasks]
+        combined.update({
+            "task_ids": [m["task_id"] for m in tasks],
+            "type": tasks[0]["type"],
+            "status": min(statuses, key=lambda s: STATUS_ORDER.index(s) if s in STATUS_ORDER else 0),
+            "request_time": tasks[0]["request_time"],
+            "completion_time": None if None in completions else max(completions),
+            "elapsed_seconds": max(elapsed) if elapsed else None,
+        })
+        elapsed_seconds = combined["elapsed_seconds"]
+        combined["throughput_bytes_per_second"] = combined["bytes_transferred"] / elapsed_seconds if elapsed_seconds else None
+        return combined
+
+    def _combined_tasks(self):
+        """The combined tasks of the latest sync, by (section, type) (call with the lock held)"""
+        return sorted((key, self._combine(group["tasks"])) for key, group in self._tasks.items())
+
+    def instrument(self, client):
+        """Wrap a transfer client so the latency of every call is recorded"""
+        return InstrumentedClient(client, self)
+
+    def report(self):
+        """The metrics as a JSON serialisable dict"""
+        with self._lock:
+            return {
+                "config": self._config_name,
+                "started": self._started,
+                "finished": time.time(),
+                "tasks": [dict(section=section, **metrics) for (section, _), metrics in self._combined_tasks()],
+                "api_calls": {
+                    method: {
+                        "count": call["count"],
+                        "errors": call["errors"],
+                        "total_seconds": call["sum"],
+                        "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], call["buckets"])),
+                    }
+                    for method, call in sorted(self._calls.items())
+                },
+                "api_retries": {method: dict(retry) for method, retry in sorted(self._retries.items())},
+                "sections": {section: dict(values) for section, values in sorted(self._sections.items())},
+            }
+
+    def write_json(self, path):
+        """Write the JSON run report"""
+        _write_atomic(path, json.dumps(self.report(), indent=4))
+
+    def write_prometheus(self, path):
+        """Write a Prometheus textfile collector file"""
+        config = _escape(self._config_name)
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP globus_sync_{name} {help_text}")
+            lines.append(f"# TYPE globus_sync_{name} {kind}")
+
+        with self._lock:
+            tasks = self._combined_tasks()
+            calls = sorted(self._calls.items())
+            retries = sorted((method, dict(retry)) for method, retry in self._retries.items())
+            sections = sorted((section, dict(values)) for section, values in self._sections.items())
+
+        gauges = [
+            ("bytes_transferred", "bytes_transferred", "Bytes transferred by the tasks of the latest sync"),
+            ("files_transferred", "files_transferred", "Files transferred by the tasks of the latest sync"),
+            ("files_skipped", "files_skipped", "Files skipped by the tasks of the latest sync"),
+            ("task_elapsed_seconds", "elapsed_seconds", "Seconds between request and completion of the longest task of the latest sync"),
+            ("throughput_bytes_per_second", "throughput_bytes_per_second", "Effective throughput of the latest sync"),
+        ]
+        for name, key, help_text in gauges:
+            metric(name, "gauge", help_text)
+            for (section, task_type), metrics in tasks:
+                if metrics[key] is not None:
+                    lines.append(f'globus_sync_{name}{{config="{config}",section="{_escape(section)}",type="{task_type}"}} {metrics[key]}')
+
+        metric("task_status", "gauge", "Status of the latest sync, the least finished of its tasks (1 for the current status)")
+        for (section, task_type), metrics in tasks:
+            lines.append(f'globus_sync_task_status{{config="{config}",section="{_escape(section)}",type="{task_type}",status="{metrics["status"]}"}} 1')
+
+        keys = sorted({key for _, values in sections for key in values})
+        for key in keys:
+            metric(f"section_{key}", "gauge", f"Per-section statistic: {key}")
+            for section, values in sections:
+                if key in values:
+                    lines.append(f'globus_sync_section_{key}{{config="{config}",section="{_escape(section)}"}} {values[key]}')
+
+        metric("api_call_duration_seconds", "histogram", "Latency of Globus Transfer API calls")
+        for method, call in calls:
+            labels = f'config="{config}",method="{method}"'
+            cumulative = 0
+            for bound, count in zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], call["buckets"]):
+                cumulative += count
+                lines.append(f'globus_sync_api_call_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"globus_sync_api_call_duration_seconds_sum{{{labels}}} {call['sum']}")
+            lines.append(f"globus_sync_api_call_duration_seconds_count{{{labels}}} {call['count']}")
+
+        metric("api_call_errors_total", "counter", "Globus Transfer API calls that raised an error")
+        for method, call in calls:
+            lines.append(f'globus_sync_api_call_errors_total{{config="{config}",method="{method}"}} {call["errors"]}')
+
+        metric("api_retries_total", "counter", "Globus Transfer API calls retried after a transient error")
+        for method, retry in retries:
+            lines.append(f'globus_sync_api_retries_total{{config="{config}",method="{method}"}} {retry["count"]}')
+
+        metric("api_backoff_seconds_total", "counter", "Time spent backing off before retrying Globus Transfer API calls")
+        for method, retry in retries:
+            lines.append(f'globus_sync_api_backoff_seconds_total{{config="{config}",method="{method}"}} {retry["backoff_seconds"]}')
+
+        metric("last_run_timestamp_seconds", "gauge", "Time the last run finished")
+        lines.append(f'globus_sync_last_run_timestamp_seconds{{config="{config}"}} {time.time()}')
+
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+class InstrumentedClient:
+    """
+    Proxy for a transfer client that times every method call
+
+    """
+    def __init__(self, client, metrics):
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            error = False
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                self._metrics.observe_call(name, time.perf_counter() - start, error=error)
+
+        return timed
@@ -0,0 +1,160 @@
+import queue
+import smtplib
+import logging
+import threading
+import email.message
+
+from . import email as mail
+from .trace import traced
+
+
+NOTIFICATION_BACKENDS = ("mail", "smtp")
+DIGEST_SUBJECT = "[Globus Sync Directory] {count} notifications"
+
+
+class MailBackend:
+    """Deliver messages with the mail command, one process per message"""
+    def send(self, recipient, subject, body):
+        mail.send_email([recipient], subject, body)
+
+    def close(self):
+        pass
+
+
+class SMTPBackend:
+    """
+    Deliver messages over a single SMTP connection, reconnecting if the server drops it
+
+    """
+    def __init__(self, host, port=25, sender="globus-sync-directory@localhost", username=None, password=None,
+                 starttls=False, use_ssl=False, timeout=30):
+        self._logger = logging.getLogger("SMTPBackend")
+        self._host = host
+        self._port = port
+        self._sender = sender
+        self._username = username
+        self._password = password
+        self._starttls = starttls
+        self._use_ssl = use_ssl
+        self._timeout = timeout
+        self._smtp = None
+
+    def _connect(self):
+        """Open (and log in to) the SMTP connection"""
+        self._logger.debug(f"Connecting to {self._host}:{self._port}")
+        smtp_class = smtplib.SMTP_SSL if self._use_ssl else smtplib.SMTP
+        smtp = smtp_class(self._host, self._port, timeout=self._timeout)
+        if self._starttls:
+            smtp.starttls()
+        if self._username:
+            smtp.login(self._username, self._password)
+        self._smtp = smtp
+
+    def send(self, recipient, subject, body):
+        msg = email.message.EmailMessage()
+        msg["From"] = self._sender
+        msg["To"] = recipient
+        msg["Subject"] = subject
+        msg.set_content(body)
+
+        # a connection left idle between runs may have been closed by the server, so retry once
+        for attempt in range(2):
+            if self._smtp is None:
+                self._connect()
+            try:
+                self._smtp.send_message(msg)
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._smtp = None
+                if attempt:
+                    raise
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except smtplib.SMTPException:
+                pass
+            self._smtp = None
+
+
+class Notifier:
+    """
+    Collect notifications during a run and deliver one digest per recipient in the background
+
+    Messages are queued with `add` from any thread and grouped by recipient
+    until `flush`, which hands the digests to a worker thread so delivery
+    never holds up polling or submissions. If the backend fails, the digest
+    is sent with the mail command instead.
+
+    """
+    def __init__(self, backend=None):
+        self._logger = logging.getLogger("Notifier")
+        self._backend = backend if backend is not None else MailBackend()
+        self._fallback = None if isinstance(self._backend, MailBackend) else MailBackend()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def add(self, recipients, subject, body):
+        """Queue a message for each of the recipients"""
+        with self._lock:
+            for recipient in recipients:
+                recipient = recipient.strip()
+                if recipient:
+                    self._pending.setdefault(recipient, []).append((subject, body))
+
+    def flush(self):
+        """Merge the queued messages into one digest per recipient and deliver them in the background"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="Notifier", daemon=True)
+                self._worker.start()
+
+        for recipient, messages in pending.items():
+            if len(messages) == 1:
+                subject, body = messages[0]
+            else:
+                subject = DIGEST_SUBJECT.format(count=len(messages))
+                body = "\n\n".join(f"=== {subject} ===\n{body}" for subject, body in messages)
+            self._queue.put((recipient, subject, body))
+
+    @traced("Notifier.deliver")
+    def _deliver(self, recipient, subject, body):
+        """Deliver a single digest, falling back to the mail command"""
+        self._logger.info(f'Sending "{subject}" to {recipient}')
+        try:
+            self._backend.send(recipient, subject, body)
+        except Exception:
+            if self._fallback is None:
+                self._logger.exception(f"Sending notification to {recipient} failed")
+                return
+            self._logger.exception(f"Sending notification to {recipient} failed, falling back to the mail command")
+            self._fallback.send(recipient, subject, body)
+
+    def _run(self):
+        """Worker thread: deliver digests until closed"""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                self._deliver(*item)
+            except Exception:
+                self._logger.exception("Delivering notification failed")
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """Deliver anything still queued and stop the worker"""
+        self.flush()
+        with self._lock:
+            worker, self._worker = self._worker, None
+        if worker is not None:
+            self._queue.put(None)
+            worker.join()
+        self._backend.close()
@@ -0,0 +1,108 @@
+import logging
+import posixpath
+import concurrent.futures
+
+import globus_sdk
+
+from .listing import iter_dir
+from .metrics import parse_time
+
+
+def _listing(tc, endpoint, path):
+    """Entries of a directory by name, or None if it does not exist"""
+    try:
+        return {entry["name"]: entry for entry in iter_dir(tc, endpoint, path)}
+    except globus_sdk.TransferAPIError as exc:
+        if exc.http_status == 404:
+            return None
+        raise
+
+
+def needs_transfer(src, dst, sync_level):
+    """
+    Whether Globus would transfer a source file over the destination one at the given sync level
+
+    Returns True, False, or None if only a checksum can tell. Like the Transfer
+    service, each level also applies the checks of the levels below it.
+
+    """
+    if dst is None or dst["type"] != src["type"]:
+        return True
+    if sync_level == "exists":
+        return False
+    if src["size"] != dst["size"]:
+        return True
+    if sync_level == "size":
+        return False
+    src_mtime = parse_time(src.get("last_modified"))
+    dst_mtime = parse_time(dst.get("last_modified"))
+    if src_mtime is None or dst_mtime is None or dst_mtime < src_mtime:
+        return True
+    if sync_level == "mtime":
+        return False
+    return None
+
+
+class TreeDiff:
+    """
+    Compare a source tree with its destination the way a sync would
+
+    Both sides are listed in parallel, one directory per job, by a bounded
+    pool of workers. Only one directory listing per job is held in memory and
+    the results are reduced to counts as they come in.
+
+    """
+    def __init__(self, tc, workers):
+        self._logger = logging.getLogger("TreeDiff")
+        self._tc = tc
+        self._workers = workers
+
+    def _compare_dir(self, src_endpoint, src_root, dst_endpoint, dst_root, rel, sync_level, path_filter, dst_exists):
+        """Compare a single directory, returning its counts and the subdirectories to visit"""
+        src_entries = _listing(self._tc, src_endpoint, posixpath.join(src_root, rel)) or {}
+        dst_entries = _listing(self._tc, dst_endpoint, posixpath.join(dst_root, rel)) if dst_exists else None
+
+        counts = {"files": 0, "bytes": 0, "files_to_verify": 0, "bytes_to_verify": 0, "files_unchanged": 0, "files_filtered": 0}
+        subdirs = []
+        for name, entry in src_entries.items():
+            child = posixpath.join(rel, name)
+            is_dir = entry["type"] == "dir"
+            if path_filter is not None and not path_filter.included(child, is_dir):
+                counts["files_filtered"] += 0 if is_dir else 1
+                continue
+            dst = dst_entries.get(name) if dst_entries is not None else None
+            if is_dir:
+                subdirs.append((child, dst is not None and dst["type"] == "dir"))
+                continue
+            changed = needs_transfer(entry, dst, sync_level)
+            if changed:
+                counts["files"] += 1
+                counts["bytes"] += entry["size"]
+            elif changed is None:
+                counts["files_to_verify"] += 1
+                counts["bytes_to_verify"] += entry["size"]
+            else:
+                counts["files_unchanged"] += 1
+        return counts, subdirs
+
+    def diff(self, src_endpoint, src_root, dst_endpoint, dst_root, sync_level, path_filter=None):
+        """Return the number of files and bytes a sync would transfer (and verify, for checksum syncs)"""
+        totals = {"files": 0, "bytes": 0, "files_to_verify": 0, "bytes_to_verify": 0, "files_unchanged": 0,
+                  "files_filtered": 0, "directories": 0}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) as executor:
+            def submit(rel, dst_exists):
+                return executor.submit(self._compare_dir, src_endpoint, src_root, dst_endpoint, dst_root,
+                                       rel, sync_level, path_filter, dst_exists)
+
+            pending = {submit("", True)}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    counts, subdirs = future.result()
+                    totals["directories"] += 1
+                    for key, value in counts.items():
+                        totals[key] += value
+                    pending.update(submit(child, dst_exists) for child, dst_exists in subdirs)
+
+        self._logger.debug(f"Diff of {src_endpoint}:{src_root} -> {dst_endpoint}:{dst_root}: {totals}")
+        return totals
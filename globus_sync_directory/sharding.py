@@ -0,0 +1,20 @@
+import heapq
+
+
+def partition(items, weights, num_shards):
+    """
+    Split items into at most num_shards lists with roughly equal total weight
+
+    Uses the greedy "largest first onto the lightest shard" heuristic. Empty
+    shards are dropped and each shard keeps the original item order.
+
+    """
+    num_shards = max(1, min(num_shards, len(items)))
+    heap = [(0, i) for i in range(num_shards)]
+    assignment = [[] for _ in range(num_shards)]
+    for index in sorted(range(len(items)), key=lambda i: weights[i], reverse=True):
+        total, shard = heapq.heappop(heap)
+        assignment[shard].append(index)
+        heapq.heappush(heap, (total + weights[index], shard))
+
+    return [[items[i] for i in sorted(indices)] for indices in assignment if indices]
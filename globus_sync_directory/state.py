@@ -0,0 +1,267 @@
+import os
+import copy
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import datetime
+import threading
+
+
+STATE_BACKENDS = ("json", "sqlite")
+DEFAULT_LEASE_MINS = 60
+
+
+def lease_owner():
+    """A name for this run, unique across hosts and processes"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class JSONStateStore:
+    """
+    Per-section state kept in a JSON file, rewritten as a whole on commit
+
+    Checkpoints in the middle of a run append the state of a single section to
+    a journal next to the file instead, which is replayed on the next load and
+    removed by the next commit.
+
+    """
+    def __init__(self, path):
+        self._logger = logging.getLogger("JSONStateStore")
+        self._path = path
+        self._journal_path = f"{self._path}.journal"
+        self._logger.debug(f"Reading cache file: {self._path}")
+        if os.path.exists(self._path):
+            with open(self._path) as fh:
+                self._data = json.load(fh)
+        else:
+            self._data = {}
+        self._replay_journal()
+        self._logger.debug(self._data)
+
+    def _replay_journal(self):
+        """Apply the checkpoints of a run that did not get to commit"""
+        if not os.path.exists(self._journal_path):
+            return
+        self._logger.info(f"Replaying checkpoints from {self._journal_path}")
+        with open(self._journal_path) as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the run died halfway through writing this line
+                    break
+                if entry["state"] is None:
+                    self._data.pop(entry["name"], None)
+                else:
+                    self._data[entry["name"]] = entry["state"]
+
+    def get(self, name):
+        """Return the state of a section, or None"""
+        return self._data.get(name)
+
+    def set(self, name, state):
+        """Replace the state of a section"""
+        # a copy, so the section can keep changing its own objects while the file is written
+        self._data[name] = copy.deepcopy(state)
+
+    def remove(self, name):
+        """Forget the state of a section"""
+        self._data.pop(name, None)
+
+    def record_tasks(self, name, tasks):
+        """The JSON file does not keep a task history"""
+        pass
+
+    def acquire(self, name, ttl):
+        """The JSON file is rewritten as a whole, so sections are not leased"""
+        return True
+
+    def release(self, name):
+        pass
+
+    def checkpoint(self, name):
+        """Persist the state of a single section without rewriting the whole file"""
+        line = json.dumps({"name": name, "state": self._data.get(name)})
+        with open(self._journal_path, "a") as fh:
+            fh.write(line + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def commit(self):
+        """Write the cache file"""
+        self._logger.debug(f"Writing cache to {self._path}")
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(self._data, fh, indent=4)
+        os.replace(tmp_path, self._path)
+        if os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+
+    def close(self):
+        pass
+
+
+class SQLiteStateStore:
+    """
+    Per-section state and the history of every task kept in a SQLite database
+
+    Every update is its own small transaction, so runs that overlap only ever
+    touch the rows of the sections they change. The database runs in WAL mode
+    so readers never block the writer.
+
+    A run leases the sections it works on: a section leased by another run
+    (until the lease expires) is not acquired, and its state is not
+    overwritten, so overlapping runs never both submit for the same section.
+
+    """
+    def __init__(self, path, migrate_from=None, owner=None):
+        self._logger = logging.getLogger("SQLiteStateStore")
+        self._path = path
+        self._owner = owner if owner is not None else lease_owner()
+        self._lock = threading.Lock()
+        is_new = not os.path.exists(path)
+
+        self._logger.debug(f"Opening state database: {path}")
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sections (
+                name TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                locked_by TEXT,
+                locked_until REAL
+            )
+        """)
+        # databases created before sections were leased
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(sections)")]
+        if "locked_by" not in columns:
+            self._conn.execute("ALTER TABLE sections ADD COLUMN locked_by TEXT")
+            self._conn.execute("ALTER TABLE sections ADD COLUMN locked_until REAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS task_history (
+                task_id TEXT PRIMARY KEY,
+                section TEXT NOT NULL,
+                type TEXT,
+                label TEXT,
+                status TEXT,
+                request_time TEXT,
+                completion_time TEXT,
+                files INTEGER,
+                files_transferred INTEGER,
+                files_skipped INTEGER,
+                bytes_transferred INTEGER,
+                recorded_at TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS task_history_section ON task_history (section, request_time)")
+
+        if is_new and migrate_from is not None and os.path.exists(migrate_from):
+            self._migrate(migrate_from)
+
+    @staticmethod
+    def _now():
+        return str(datetime.datetime.utcnow())
+
+    def _migrate(self, json_path):
+        """One-time import of an existing JSON cache file"""
+        self._logger.info(f"Migrating cache file {json_path} to {self._path}")
+        with open(json_path) as fh:
+            data = json.load(fh)
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            for name, state in data.items():
+                self._conn.execute("INSERT OR REPLACE INTO sections (name, state, updated_at) VALUES (?, ?, ?)",
+                                   (name, json.dumps(state), self._now()))
+        # keep the old file around, but make sure it is not picked up again
+        os.replace(json_path, f"{json_path}.migrated")
+
+    def get(self, name):
+        """Return the state of a section, or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM sections WHERE name = ?", (name,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, name, state):
+        """Replace the state of a section, unless another run has taken over its lease"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO sections (name, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at "
+                "WHERE sections.locked_by IS NULL OR sections.locked_by = ? OR sections.locked_until < ?",
+                (name, json.dumps(state), self._now(), self._owner, time.time()),
+            )
+        if cursor.rowcount == 0:
+            self._logger.warning(f"Section {name} is leased by another run, not saving its state")
+
+    def remove(self, name):
+        """Forget the state of a section (keeping its lease)"""
+        self.set(name, None)
+
+    def acquire(self, name, ttl):
+        """Lease (or renew the lease of) a section for ttl seconds, returning False if another run holds it"""
+        now = time.time()
+        with self._lock, self._conn:
+            # taken before reading, so two runs cannot both see the section as free
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute("SELECT locked_by, locked_until FROM sections WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] not in (None, self._owner) and row[1] is not None and row[1] > now:
+                self._logger.debug(f"Section {name} is leased by {row[0]} until {row[1]}")
+                return False
+            self._conn.execute(
+                "INSERT INTO sections (name, state, updated_at, locked_by, locked_until) VALUES (?, 'null', ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET locked_by = excluded.locked_by, locked_until = excluded.locked_until",
+                (name, self._now(), self._owner, now + ttl),
+            )
+        return True
+
+    def release(self, name):
+        """Give up the lease of a section, if we hold it"""
+        with self._lock:
+            self._conn.execute("UPDATE sections SET locked_by = NULL, locked_until = NULL WHERE name = ? AND locked_by = ?",
+                               (name, self._owner))
+
+    def record_tasks(self, name, tasks):
+        """Add or update task documents in the history"""
+        if not tasks:
+            return
+        rows = [
+            (task["task_id"], name, task.get("type"), task.get("label"), task.get("status"),
+             task.get("request_time"), task.get("completion_time"), task.get("files"),
+             task.get("files_transferred"), task.get("files_skipped"), task.get("bytes_transferred"),
+             self._now())
+            for task in tasks
+        ]
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO task_history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def checkpoint(self, name):
+        """Every update is committed as it happens"""
+        pass
+
+    def commit(self):
+        """Every update is committed as it happens"""
+        pass
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_state_store(backend, cache_file, owner=None):
+    """Create the state store for the given backend (owner names the run holding the leases)"""
+    if backend == "json":
+        return JSONStateStore(cache_file)
+    elif backend == "sqlite":
+        root, ext = os.path.splitext(str(cache_file))
+        if ext in (".db", ".sqlite"):
+            return SQLiteStateStore(cache_file, owner=owner)
+        # an existing JSON cache file is migrated the first time the database is created
+        return SQLiteStateStore(f"{root}.db", migrate_from=cache_file, owner=owner)
+    else:
+        raise ValueError(f'Unknown state backend "{backend}", must be one of: {", ".join(STATE_BACKENDS)}')
@@ -0,0 +1,127 @@
+"""
+Status of the current tasks served from the snapshots in the cache, without talking to Globus.
+
+This module must not import globus_sdk (directly or through the other modules),
+so the status can be printed without paying for the import.
+
+"""
+import time
+import logging
+import configparser
+
+from .state import open_state_store
+from .trace import traced
+
+
+STATUS_KEYS = [
+    "status",
+    "request_time",
+    "deadline",
+    "completion_time",
+    "directories",
+    "files",
+    "files_skipped",
+    "files_transferred",
+    "bytes_transferred",
+    "bytes_checksummed",
+]
+# task fields kept in the snapshots, on top of STATUS_KEYS
+SNAPSHOT_KEYS = ["task_id", "type", "label", "is_ok"]
+FINISHED_STATUS = ("SUCCEEDED", "FAILED")
+DEFAULT_SNAPSHOT_MAX_AGE_MINS = 10
+# sections of the config file that are not transfers
+OTHER_SECTIONS = ("schedule", "globus", "notification", "concurrency", "metrics", "daemon")
+
+
+def snapshot_task(task_info, fetched_at):
+    """The parts of a task document worth keeping in the cache, with the time it was fetched"""
+    snapshot = {key: task_info.get(key) for key in SNAPSHOT_KEYS + STATUS_KEYS}
+    snapshot["fetched_at"] = fetched_at
+    return snapshot
+
+
+def is_fresh(snapshot, max_age, now):
+    """Whether a snapshot can stand in for the task: it has finished, or was fetched recently enough"""
+    return snapshot["status"] in FINISHED_STATUS or now - snapshot["fetched_at"] <= max_age
+
+
+def read_snapshot_max_age(config_file):
+    """The maximum age of a snapshot, in seconds, from the [schedule] section"""
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    return 60 * config.getfloat("schedule", "snapshot_max_age_mins", fallback=DEFAULT_SNAPSHOT_MAX_AGE_MINS)
+
+
+class OfflineStatus:
+    """
+    Report the status of each section from the task snapshots stored in the cache
+
+    A section is stale if one of its current tasks has no snapshot, or an
+    unfinished one older than the maximum age; those are left for a refresh
+    from Globus.
+
+    """
+    def __init__(self, config_file, cache_file, state_backend="json", max_age=None):
+        self._logger = logging.getLogger("OfflineStatus")
+        self._config_file = config_file
+        self._cache_file = cache_file
+        self._state_backend = state_backend
+        self._max_age = read_snapshot_max_age(config_file) if max_age is None else max_age
+
+    def _sections(self):
+        """Names of the transfer sections in the config file"""
+        if not self._config_file.exists():
+            raise ValueError(f"Config file does not exist: {self._config_file}")
+        config = configparser.ConfigParser()
+        config.read(self._config_file)
+        return [s for s in config.sections() if s not in OTHER_SECTIONS]
+
+    def _report_section(self, name, state, now):
+        """Return the report lines of a section, or None if it is stale"""
+        state = state or {}
+        snapshots = state.get("snapshots", {})
+        task_ids = list(state.get("transfer_ids", []))
+        task_ids.extend(state.get("deletion_ids", []))
+        if "transfer_id" in state:
+            task_ids.append(state["transfer_id"])
+        if "deletion_id" in state:
+            task_ids.append(state["deletion_id"])
+
+        # report the current tasks, or the last ones seen if nothing is running
+        for task_id in task_ids:
+            if task_id not in snapshots or not is_fresh(snapshots[task_id], self._max_age, now):
+                return None
+        if not task_ids:
+            task_ids = list(snapshots)
+        if not task_ids:
+            return [f"[{name}]: No current transfer", ""]
+
+        lines = []
+        for task_id in task_ids:
+            snapshot = snapshots[task_id]
+            label = "deletion" if snapshot["type"] == "DELETE" else "transfer"
+            age = (now - snapshot["fetched_at"]) / 60
+            lines.append(f"[{name}]: Status of {label} with id {task_id} (as of {age:.0f} minutes ago):")
+            for key in STATUS_KEYS:
+                lines.append(f"[{name}]:   {key}: {snapshot[key]}")
+            lines.append("")
+        return lines
+
+    @traced("OfflineStatus.report")
+    def report(self):
+        """Return the report lines of the fresh sections, and the names of the stale ones"""
+        now = time.time()
+        output = []
+        stale = []
+        cache = open_state_store(self._state_backend, self._cache_file)
+        try:
+            for name in self._sections():
+                lines = self._report_section(name, cache.get(name), now)
+                if lines is None:
+                    stale.append(name)
+                else:
+                    output.extend(lines)
+        finally:
+            cache.close()
+        self._logger.info(f"{len(stale)} sections need refreshing from Globus")
+        return output, stale
@@ -1,17 +1,34 @@
 
-import os
 import configparser
-import json
 import datetime
 import subprocess
 import logging
+import threading
+import concurrent.futures
+from pathlib import Path
 
 import globus_sdk
 
-from .transfer import Transfer
-from . import email
+from .transfer import Transfer, VALID_STALL_ACTIONS, VALID_TOPOLOGIES, nice_size
+from .notify import Notifier, SMTPBackend, NOTIFICATION_BACKENDS
+from .tokenstore import TokenStore
+from .state import open_state_store, DEFAULT_LEASE_MINS
+from .metrics import Metrics
+from .listing import iter_paginated
+from . import api
+from . import trace
+from .trace import traced
+from .manifest import Manifest
+from .synclevel import SyncLevelPolicy
+from .deadline import DeadlinePolicy, DEFAULT_DEADLINE_MARGIN, DEFAULT_MIN_DEADLINE_MINS
+from .filters import PathFilter, parse_patterns
+from .watcher import create_watcher, DEFAULT_SETTLE_SECS
+from .concurrency import CallCache, EndpointLimiter, DEFAULT_WORKERS, DEFAULT_MAX_PER_ENDPOINT
+from .status import OTHER_SECTIONS
 
 
+# number of task ids to put in a single task_list filter
+TASK_LIST_BATCH_SIZE = 50
 VALID_SYNC_LEVELS = [
     "exists",
     "size",
@@ -25,28 +42,55 @@ class Syncer:
     Sync directories between Globus endpoints
 
     """
-    def __init__(self, config_file, secret_file, cache_file):
+    def __init__(self, config_file, secret_file, cache_file, state_backend="json", transfer_client=None, call_cache=None,
+                 long_running=False, sections=None, lease_owner=None):
         self._logger = logging.getLogger("Syncer")
         self._config_file = config_file
         self._cache_file = cache_file
+        self._state_backend = state_backend
+        self._cache_lock = threading.Lock()
+        self._manifest_dir = Path(cache_file).with_name(Path(cache_file).stem + "_manifests")
+        self._long_running = long_running
+        self._sections = sections
+        self._lease_owner = lease_owner
+        self._locked_out = []
 
         # parse the config file
         self._parse_config()
+        if self._secret_file is not None:
+            secret_file = self._secret_file
 
-        # load the secret
-        self._logger.info(f"Loading client secret from {secret_file}")
-        with open(secret_file) as fh:
-            self._client_secret = fh.readline().strip()
+        # a ready made transfer client (e.g. the simulated one used by the benchmarks) skips authentication
+        if transfer_client is None:
+            # load the secret
+            self._logger.info(f"Loading client secret from {secret_file}")
+            with open(secret_file) as fh:
+                self._client_secret = fh.readline().strip()
+
+            # access tokens are cached next to the secret file between runs
+            self._token_store = TokenStore(secret_file, self._client_id)
 
         # create the Globus transfer client
-        self._create_transfer_client()
+        self._create_transfer_client(transfer_client)
 
         # check access to the endpoints
-        self._check_endpoints()
+        self._check_endpoints(call_cache)
+
+        # watch local sources for changes
+        for t in self._transfers:
+            t.start_watching()
 
         # read in the cache
         self._read_cache()
 
+    @staticmethod
+    def read_client_id(config_file):
+        """Return the clientid of a config file without loading the rest of it"""
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        return config.get("globus", "clientid", fallback=None)
+
+    @traced("Syncer.parse_config")
     def _parse_config(self):
         """Parse the config file"""
         config_file = self._config_file
@@ -61,21 +105,84 @@ class Syncer:
             self._client_id = config["globus"]["clientid"]
         except KeyError:
             raise KeyError(f"Config file must have [globus] section with clientid")
+        # the client secret (optional, defaults to the one given on the command line)
+        self._secret_file = config.get("globus", "secret_file", fallback=None)
+        if self._secret_file is not None:
+            self._secret_file = Path(self._secret_file).expanduser()
 
         # transfer deadline
-        timelimitmins = config.getint("schedule", "timelimitmins", fallback=1440)  # default is 24 hours
-        now = datetime.datetime.utcnow()
-        deadline = now + datetime.timedelta(minutes=timelimitmins)
-        self._deadline = str(deadline)
-        self._logger.info(f"  deadline: {self._deadline} (now: {now})")
+        self._timelimitmins = config.getint("schedule", "timelimitmins", fallback=1440)  # default is 24 hours
+        self._deadline = self._compute_deadline()
+        self._logger.info(f"  deadline: {self._deadline}")
+        # give each transfer a deadline from its predicted duration instead (bounded by timelimitmins)
+        self._adaptive_deadline = config.getboolean("schedule", "adaptive_deadline", fallback=False)
+        self._deadline_margin = config.getfloat("schedule", "deadline_margin", fallback=DEFAULT_DEADLINE_MARGIN)
+        self._min_deadline_mins = config.getfloat("schedule", "min_deadline_mins", fallback=DEFAULT_MIN_DEADLINE_MINS)
+
+        # stalled transfer detection defaults
+        self._stall_mins = config.getfloat("schedule", "stall_mins", fallback=0)
+        self._stall_action = config.get("schedule", "stall_action", fallback="report")
+        # compare source and destination before starting a sync and skip it if there is nothing to do
+        self._skip_empty_plan = config.getboolean("schedule", "skip_empty_plan", fallback=False)
+        # how long a run may keep the sections it works on to itself (only with the sqlite state backend)
+        self._lease_secs = 60 * config.getfloat("schedule", "lease_mins", fallback=DEFAULT_LEASE_MINS)
+        # maximum number of active tasks for the app identity, new transfers over it wait (0 means unlimited)
+        self._max_active_tasks = config.getint("schedule", "max_active_tasks", fallback=0)
+        if self._max_active_tasks < 0:
+            raise ValueError(f"[schedule] max_active_tasks must not be negative (got {self._max_active_tasks})")
+
+        # number of worker threads for talking to Globus
+        self._workers = config.getint("concurrency", "workers", fallback=DEFAULT_WORKERS)
+        if self._workers < 1:
+            raise ValueError(f"[concurrency] workers must be at least 1 (got {self._workers})")
+        self._logger.info(f"  workers: {self._workers}")
+
+        # maximum number of transfers processed at once on a single endpoint (0 means unlimited)
+        self._max_per_src_endpoint = config.getint("concurrency", "max_per_src_endpoint", fallback=DEFAULT_MAX_PER_ENDPOINT)
+        self._max_per_dst_endpoint = config.getint("concurrency", "max_per_dst_endpoint", fallback=DEFAULT_MAX_PER_ENDPOINT)
+        self._logger.info(f"  max per source endpoint: {self._max_per_src_endpoint}")
+        self._logger.info(f"  max per destination endpoint: {self._max_per_dst_endpoint}")
+
+        # rate limit (calls per second, 0 means unlimited) and retries of transient Globus API errors
+        self._rate_limit = config.getfloat("concurrency", "rate_limit", fallback=api.DEFAULT_RATE_LIMIT)
+        self._rate_burst = config.getint("concurrency", "rate_burst", fallback=api.DEFAULT_BURST)
+        self._max_retries = config.getint("concurrency", "max_retries", fallback=api.DEFAULT_MAX_RETRIES)
+        self._backoff_base = config.getfloat("concurrency", "backoff_base", fallback=api.DEFAULT_BACKOFF_BASE)
+        self._backoff_max = config.getfloat("concurrency", "backoff_max", fallback=api.DEFAULT_BACKOFF_MAX)
+        self._logger.info(f"  rate limit: {self._rate_limit}/s (burst {self._rate_burst}), max retries: {self._max_retries}")
+
+        # metrics export (optional)
+        self._metrics_prometheus_file = config.get("metrics", "prometheus_file", fallback=None)
+        self._metrics_json_file = config.get("metrics", "json_file", fallback=None)
+        self._metrics = Metrics(str(config_file))
+        self._logger.info(f"  metrics files: {self._metrics_prometheus_file}, {self._metrics_json_file}")
 
         # email notification
         self._notify_email = config.get("notification", "email", fallback=None)
         self._logger.info(f"  notify email: {self._notify_email}")
 
+        # messages are collected into one digest per recipient and delivered in the background
+        backend = config.get("notification", "backend", fallback="mail")
+        if backend not in NOTIFICATION_BACKENDS:
+            raise ValueError(f'[notification] backend "{backend}" is not valid')
+        if backend == "smtp":
+            self._notifier = Notifier(SMTPBackend(
+                config.get("notification", "smtp_host", fallback="localhost"),
+                port=config.getint("notification", "smtp_port", fallback=25),
+                sender=config.get("notification", "smtp_from", fallback="globus-sync-directory@localhost"),
+                username=config.get("notification", "smtp_username", fallback=None),
+                password=config.get("notification", "smtp_password", fallback=None),
+                starttls=config.getboolean("notification", "smtp_starttls", fallback=False),
+                use_ssl=config.getboolean("notification", "smtp_ssl", fallback=False),
+            ))
+        else:
+            self._notifier = Notifier()
+        self._logger.info(f"  notification backend: {backend}")
+
         # read the transfer sections
-        other_sections = ("schedule", "globus", "notification")
-        transfer_sections = [s for s in config.sections() if s not in other_sections]
+        transfer_sections = [s for s in config.sections() if s not in OTHER_SECTIONS]
+        if self._sections is not None:
+            transfer_sections = [s for s in transfer_sections if s in self._sections]
         self._transfers = []
         for transfer_section in transfer_sections:
             self._logger.debug(f"Reading transfer section: {transfer_section}")
@@ -87,14 +194,25 @@ class Syncer:
                 raise
             # source path (optional default to root)
             src_path = config.get(transfer_section, "src_path", fallback="/")
-            # destination endpoint (required)
+            # destination endpoint, or comma separated endpoints (required)
             try:
-                dst_endpoint = config[transfer_section]["dst_endpoint"]
+                dst_endpoints = [e.strip() for e in config[transfer_section]["dst_endpoint"].split(",") if e.strip()]
             except KeyError:
                 self._logger.error(f"No 'dst_endpoint' in transfer section '{transfer_section}'")
                 raise
-            # destination path (optional, defaults to source path)
-            dst_path = config.get(transfer_section, "dst_path", fallback=src_path)
+            # destination path, or one comma separated path per destination (optional, defaults to source path)
+            dst_paths = [p.strip() for p in config.get(transfer_section, "dst_path", fallback=src_path).split(",")]
+            if len(dst_paths) == 1:
+                dst_paths = dst_paths * len(dst_endpoints)
+            if len(dst_paths) != len(dst_endpoints):
+                raise ValueError(f'transfer section "{transfer_section}" must have one dst_path, or one per dst_endpoint')
+            dst_endpoint, dst_path = dst_endpoints[0], dst_paths[0]
+            extra_destinations = list(zip(dst_endpoints[1:], dst_paths[1:]))
+            # with several destinations, send everything from the source or relay it via the first destination
+            # (optional, default to fanout)
+            topology = config.get(transfer_section, "topology", fallback="fanout")
+            if topology not in VALID_TOPOLOGIES:
+                raise ValueError(f'topology "{topology}" in transfer section "{transfer_section}" is not valid')
             # transfer email (optional)
             transfer_email = config.get(transfer_section, "email", fallback=None)
             # delete source files when transfer is complete (optional default to False)
@@ -104,14 +222,112 @@ class Syncer:
             if sync_level not in VALID_SYNC_LEVELS:
                 self._logger.error(f'"{sync_level}" in transfer section "{transfer_section}" is not valid')
                 raise ValueError(f'"{sync_level}" in transfer section "{transfer_section}" is not valid')
+            # glob patterns of file and directory names to transfer or leave on the source (optional)
+            path_filter = PathFilter(
+                include=parse_patterns(config.get(transfer_section, "include", fallback="")),
+                exclude=parse_patterns(config.get(transfer_section, "exclude", fallback="")),
+            )
+            # only transfer subtrees that changed since the last successful sync (optional, default to False)
+            manifest = None
+            if config.getboolean(transfer_section, "manifest", fallback=False):
+                manifest = Manifest(self._manifest_dir, transfer_section, self._workers, path_filter=path_filter)
+            # split the transfer into this many parallel tasks (optional, default to 1)
+            shard = config.getint(transfer_section, "shard", fallback=1)
+            if shard < 1:
+                raise ValueError(f'shard in transfer section "{transfer_section}" must be at least 1')
+            # escalate to checksum syncs periodically or after a failure (optional, default to never)
+            sync_policy = SyncLevelPolicy(
+                sync_level,
+                every_runs=config.getint(transfer_section, "checksum_every_runs", fallback=0),
+                every_days=config.getfloat(transfer_section, "checksum_every_days", fallback=0),
+                after_failure=config.getboolean(transfer_section, "checksum_after_failure", fallback=False),
+            )
+            # cancel or report transfers with no progress for this long (optional, default from [schedule], 0 disables)
+            stall_mins = config.getfloat(transfer_section, "stall_mins", fallback=self._stall_mins)
+            stall_action = config.get(transfer_section, "stall_action", fallback=self._stall_action)
+            if stall_action not in VALID_STALL_ACTIONS:
+                raise ValueError(f'stall_action "{stall_action}" in transfer section "{transfer_section}" is not valid')
+            # only sync when the source, seen locally at this path, has changed and writes have settled (optional)
+            watcher = None
+            settle_secs = config.getfloat(transfer_section, "settle_secs", fallback=DEFAULT_SETTLE_SECS)
+            local_path = config.get(transfer_section, "local_path", fallback=None)
+            if local_path is not None:
+                watcher = create_watcher(config.get(transfer_section, "watcher", fallback="auto"), local_path,
+                                         self._manifest_dir, transfer_section, path_filter=path_filter or None,
+                                         long_running=self._long_running)
+            # skip syncs with nothing to transfer (optional, default from [schedule])
+            skip_empty_plan = config.getboolean(transfer_section, "skip_empty_plan", fallback=self._skip_empty_plan)
+            # deadline from the section's throughput history (optional, defaults from [schedule])
+            deadline_policy = DeadlinePolicy(
+                self._timelimitmins,
+                adaptive=config.getboolean(transfer_section, "adaptive_deadline", fallback=self._adaptive_deadline),
+                margin=config.getfloat(transfer_section, "deadline_margin", fallback=self._deadline_margin),
+                min_mins=config.getfloat(transfer_section, "min_deadline_mins", fallback=self._min_deadline_mins),
+            )
+            if deadline_policy.adaptive and deadline_policy.margin < 1:
+                raise ValueError(f'deadline_margin in transfer section "{transfer_section}" must be at least 1')
+            # sections with a higher priority are started first when the active task limit is reached (optional, default 0)
+            priority = config.getint(transfer_section, "priority", fallback=0)
             # create the Transfer object
             self._transfers.append(Transfer(transfer_section, src_endpoint, src_path,
                                             dst_endpoint, dst_path, self._deadline,
-                                            transfer_email, delete, sync_level))
+                                            transfer_email, delete, sync_level,
+                                            manifest=manifest, shard=shard,
+                                            stall_mins=stall_mins, stall_action=stall_action,
+                                            sync_policy=sync_policy, path_filter=path_filter,
+                                            skip_empty_plan=skip_empty_plan, workers=self._workers,
+                                            extra_destinations=extra_destinations, topology=topology,
+                                            watcher=watcher, settle_secs=settle_secs, priority=priority,
+                                            deadline_policy=deadline_policy))
+            self._transfers[-1].set_notifier(self._notifier)
             self._logger.info(f'  adding transfer: {self._transfers[-1]}')
 
-    def _create_transfer_client(self):
+    def _compute_deadline(self):
+        """Deadline for transfers submitted now"""
+        now = datetime.datetime.utcnow()
+        return str(now + datetime.timedelta(minutes=self._timelimitmins))
+
+    def trace_tags(self):
+        """Tags of the trace spans of this syncer"""
+        return {"config": self._config_file}
+
+    @property
+    def config_file(self):
+        """The config file this syncer was created from"""
+        return self._config_file
+
+    @property
+    def client_id(self):
+        """The Globus application client ID"""
+        return self._client_id
+
+    @property
+    def transfer_client(self):
+        """The underlying transfer client, without the rate limiting and instrumentation wrappers"""
+        return self._raw_transfer_client
+
+    def _create_transfer_client(self, transfer_client=None):
         """Authenticate the app and Create the transfer client"""
+        if transfer_client is None:
+            transfer_client = self._authenticate()
+        else:
+            self._logger.debug("Using the given transfer client")
+        self._raw_transfer_client = transfer_client
+
+        # every call is timed (and traced, if enabled), rate limited and retried on transient errors
+        self._transfer_client = api.ResilientClient(
+            trace.instrument(self._metrics.instrument(transfer_client)), metrics=self._metrics,
+            rate_limit=self._rate_limit, burst=self._rate_burst, max_retries=self._max_retries,
+            backoff_base=self._backoff_base, backoff_max=self._backoff_max,
+        )
+
+        # pass transfer client
+        for t in self._transfers:
+            t.set_transfer_client(self._transfer_client, self._client_id)
+
+    @traced("Syncer.authenticate")
+    def _authenticate(self):
+        """Authenticate the app and return a new transfer client"""
         self._logger.debug("Creating transfer client")
 
         # create the transfer client
@@ -119,58 +335,294 @@ class Syncer:
             client_id=self._client_id, client_secret=self._client_secret
         )
         scopes = "urn:globus:auth:scope:transfer.api.globus.org:all"
-        cc_authorizer = globus_sdk.ClientCredentialsAuthorizer(confidential_client, scopes)
-        self._transfer_client = globus_sdk.TransferClient(authorizer=cc_authorizer)
-
-        # pass transfer client
-        for t in self._transfers:
-            t.set_transfer_client(self._transfer_client, self._client_id)
+        access_token, expires_at = self._token_store.load()
+        cc_authorizer = globus_sdk.ClientCredentialsAuthorizer(
+            confidential_client, scopes,
+            access_token=access_token, expires_at=expires_at,
+            on_refresh=self._token_store.on_refresh,
+        )
+        # the SDK's own retries are turned off, ResilientClient retries (rate limited and counted) instead
+        return globus_sdk.TransferClient(authorizer=cc_authorizer, transport_params={"max_retries": 0})
 
-    def _check_endpoints(self):
+    @traced("Syncer.check_endpoints")
+    def _check_endpoints(self, call_cache=None):
         """Check that the app has access to the endpoints"""
         self._logger.debug(f"Checking access to the endpoints")
+
+        # endpoints shared between transfers (or between syncers with the same client) are only activated and listed once
+        if call_cache is None:
+            call_cache = CallCache()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) as executor:
+            results = list(executor.map(lambda t: t.check_endpoints(call_cache=call_cache), self._transfers))
+
         good_transfers = []
-        for t in self._transfers:
-            errors = t.check_endpoints()
+        for t, errors in zip(self._transfers, results):
             if errors:
                 self._logger.error(f"Skipping transfer due to failed endpoint check: {t}")
             else:
                 good_transfers.append(t)
         self._transfers = good_transfers
 
+    @traced("Syncer.read_cache")
     def _read_cache(self):
-        """Read cache file"""
-        self._logger.debug(f"Reading cache file: {self._cache_file}")
-        if os.path.exists(self._cache_file):
-            with open(self._cache_file) as fh:
-                self._cache = json.load(fh)
-        else:
-            self._cache = {}
-        self._logger.debug(self._cache)
+        """Open the state store and load the state of each section this run can lease"""
+        self._cache = open_state_store(self._state_backend, self._cache_file, owner=self._lease_owner)
+        self._all_transfers = self._transfers
+        self._transfers = []
+        for t in self._all_transfers:
+            t.set_checkpoint(self._checkpoint)
 
-        for t in self._transfers:
-            t.read_cache(self._cache)
+        # leave the sections another (overlapping) run is working on to that run
+        self._renew_leases()
+
+    def _renew_leases(self):
+        """Lease (or renew) the sections for this pass, skipping those another run holds until it lets them go"""
+        leased = []
+        self._locked_out = []
+        for t in self._all_transfers:
+            if not self._cache.acquire(t.name, self._lease_secs):
+                self._logger.warning(f"Skipping {t.name}, another run is working on it")
+                self._locked_out.append(t.name)
+                continue
+            if t not in self._transfers:
+                # new to this run, or back from another run that may have changed its state
+                t.read_cache(self._cache)
+            leased.append(t)
+        self._transfers = leased
 
+    @traced("Syncer.write_cache")
     def _write_cache(self):
-        """Write the task_id to cache file"""
-        self._logger.debug(f"Writing cache to {self._cache_file}")
-        with open(self._cache_file, "w") as fh:
-            json.dump(self._cache, fh, indent=4)
-
-    def process(self, start=True):
-        """process each transfer"""
-        # process the transfers
+        """Commit the state store"""
+        self._cache.commit()
+
+    def _save_transfer(self, t):
+        """Record the tasks seen by a transfer and store its state (call with the cache lock held)"""
+        for run, task_info in t.get_seen_tasks():
+            self._metrics.record_task(t.name, task_info, run=run)
+        self._metrics.record_section(t.name, **t.stall_stats(), **t.deadline_stats())
+        t.set_cache(self._cache)
+
+    def _checkpoint(self, t):
+        """Persist a single transfer's state in the middle of a run"""
+        with self._cache_lock:
+            self._save_transfer(t)
+            self._cache.checkpoint(t.name)
+
+    @traced("Syncer.prefetch_tasks")
+    def _prefetch_tasks(self):
+        """Fetch the status of every cached task in bulk and hand the documents to the transfers"""
+        task_ids = []
+        for t in self._transfers:
+            task_ids.extend(t.get_task_ids())
+        self._logger.debug(f"Prefetching {len(task_ids)} tasks")
+
+        tasks = {}
+        try:
+            for i in range(0, len(task_ids), TASK_LIST_BATCH_SIZE):
+                batch = task_ids[i:i + TASK_LIST_BATCH_SIZE]
+                task_filter = "task_id:" + ",".join(batch)
+                for task in iter_paginated(self._transfer_client.task_list, filter=task_filter, limit=len(batch)):
+                    tasks[task["task_id"]] = task
+        except globus_sdk.GlobusError as exc:
+            # only an optimisation, the transfers check the remaining tasks one by one
+            self._logger.warning(f"Could not prefetch the task status in bulk, using get_task instead: {exc}")
+
+        # transfers fall back to get_task for anything missing from the results
+        for t in self._transfers:
+            t.set_prefetched_tasks({task_id: tasks[task_id] for task_id in t.get_task_ids() if task_id in tasks})
+
+    @traced("Syncer.count_active_tasks")
+    def _count_active_tasks(self):
+        """Number of tasks of the app identity that are still running (including those of other configs)"""
+        tasks = iter_paginated(self._transfer_client.task_list, filter="status:ACTIVE,INACTIVE", limit=1000)
+        return sum(1 for _ in tasks)
+
+    def _schedule(self, due):
+        """
+        Choose which of the due transfers to start in this pass, deferring the rest
+
+        Transfers are taken by priority (highest first), then by how long they
+        have gone without a successful sync, until the next one's tasks do not
+        fit below the maximum number of active tasks.
+
+        """
+        due = sorted(due, key=lambda t: (-t.priority, t.last_succeeded or 0))
+        # nothing due means no need to count the active tasks (an API call) either
+        if not due or not self._max_active_tasks:
+            return due
+
+        active = self._count_active_tasks()
+        budget = self._max_active_tasks - active
+        self._logger.info(f"{active} active tasks, limit {self._max_active_tasks}, {len(due)} transfers due")
+        selected = []
+        starting = 0
+        for i, t in enumerate(due):
+            # a transfer with more tasks than the limit can still start on its own
+            if starting + t.tasks_per_start() > budget and active + starting > 0:
+                # stop at the first one that does not fit, so big (sharded) transfers are not starved by small ones
+                for deferred in due[i:]:
+                    deferred.defer(f"limit of {self._max_active_tasks} active tasks reached ({active} active, "
+                                   f"{starting} starting for higher-ranked sections), priority {deferred.priority}")
+                break
+            selected.append(t)
+            starting += t.tasks_per_start()
+        return selected
+
+    @traced("Syncer.write_metrics")
+    def _write_metrics(self):
+        """Write the metrics files, if configured"""
+        if self._metrics_prometheus_file is not None:
+            self._logger.debug(f"Writing Prometheus metrics to {self._metrics_prometheus_file}")
+            self._metrics.write_prometheus(self._metrics_prometheus_file)
+        if self._metrics_json_file is not None:
+            self._logger.debug(f"Writing JSON run report to {self._metrics_json_file}")
+            self._metrics.write_json(self._metrics_json_file)
+
+    def get_activity(self, min_interval=0):
+        """
+        Summarise the state of the transfers after a call to process
+
+        Returns the number of busy transfers, the bytes transferred so far by the
+        active tasks and the number of seconds until an idle transfer is due to start.
+
+        """
+        busy = [t for t in self._transfers if t.is_busy()]
+        idle = [t for t in self._transfers if not t.is_busy()]
+        active_bytes = sum(t.active_bytes() for t in busy)
+        next_due = min((t.seconds_until_due(min_interval) for t in idle), default=None)
+        return len(busy), active_bytes, next_due
+
+    def summary(self):
+        """Count the sections, and those busy or with failed tasks, after a call to process"""
+        return {
+            "sections": len(self._transfers),
+            "busy": sum(1 for t in self._transfers if t.is_busy()),
+            "failed": sum(1 for t in self._transfers if t.had_failures()),
+        }
+
+    @traced("Syncer.close")
+    def close(self, keep_leases=()):
+        """Stop the watchers, deliver any pending notifications and release the sections (except keep_leases) and state store"""
+        for t in self._all_transfers:
+            t.stop_watching()
+        self._notifier.close()
+        for t in self._transfers:
+            if t.name not in keep_leases:
+                self._cache.release(t.name)
+        self._cache.close()
+
+    @property
+    def section_names(self):
+        """Names of the sections this syncer works on"""
+        return [t.name for t in self._transfers]
+
+    @traced("Syncer.plan")
+    def plan(self):
+        """
+        Report what a new sync of each section would transfer and how long it would take
+
+        Nothing is submitted and the state is left alone. Sections that are busy
+        are reported as such, since their next sync depends on the current one,
+        as are sections that could not be planned (e.g. a listing was refused).
+
+        """
         output = []
+        total_bytes = 0
+        total_eta = 0
+        for t in self._transfers:
+            if t.is_busy():
+                output.append(f"[{t.name}]: busy, a transfer or deletion is still in progress")
+                continue
+            try:
+                result = t.plan()
+            except Exception as exc:
+                self._logger.exception(f"Error while planning {t.name}")
+                output.append(f"[{t.name}]: ERROR while planning: {exc}")
+                continue
+            total_bytes += result["bytes"]
+            line = (f"[{t.name}]: {result['sync_level']}: {result['files']} files ({nice_size(result['bytes'])}) to transfer, "
+                    f"{result['files_unchanged']} unchanged")
+            if result["files_to_verify"]:
+                line += f", {result['files_to_verify']} ({nice_size(result['bytes_to_verify'])}) to checksum"
+            if result["files_filtered"]:
+                line += f", {result['files_filtered']} filtered out"
+            if result["eta_seconds"] is None:
+                line += ", ETA unknown (no throughput history)"
+            else:
+                total_eta = max(total_eta, result["eta_seconds"])
+                line += f", ETA {datetime.timedelta(seconds=round(result['eta_seconds']))} at {nice_size(result['throughput'])}/s"
+                if result["eta_seconds"] > 60 * self._timelimitmins:
+                    line += f" - will NOT finish within timelimitmins ({self._timelimitmins})"
+            output.append(line)
+        output.append(f"Total: {nice_size(total_bytes)} to transfer, longest ETA {datetime.timedelta(seconds=round(total_eta))}")
+        return output
+
+    @traced("Syncer.process")
+    def process(self, start=True, min_interval=0, notify_on_events_only=False, notify=True):
+        """process each transfer, returning the status report"""
+        # deadline for anything submitted in this pass
+        self._deadline = self._compute_deadline()
         for t in self._transfers:
-            t.process(start=start)
-            t.set_cache(self._cache)
-            output.extend(t.get_msg())
+            t.set_deadline(self._deadline)
+
+        # keep the sections to ourselves for another lease period
+        self._renew_leases()
+
+        # fetch the status of the current tasks in bulk
+        self._prefetch_tasks()
 
-        # write the cache file
-        self._write_cache()
+        # process the transfers in parallel, limiting how many run against each endpoint
+        limiter = EndpointLimiter(self._max_per_src_endpoint, self._max_per_dst_endpoint)
+        # an error in one section is reported and must not lose what the others did in this pass
+        errors = set()
 
-        # notify
-        if len(output):
+        def update_transfer(t):
+            with limiter.limit(t.src_endpoint, t.dst_endpoint):
+                try:
+                    t.update(start=start)
+                except Exception as exc:
+                    t.report_error("checking the status", exc)
+                    errors.add(t.name)
+
+        def start_transfer(t):
+            with limiter.limit(t.src_endpoint, t.dst_endpoint):
+                try:
+                    t.start_new()
+                except Exception as exc:
+                    t.report_error("starting a new transfer", exc)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) as executor:
+            # check the current tasks first, so finished ones free their slots
+            list(executor.map(update_transfer, self._transfers))
+
+            # then start the due transfers that fit, most urgent first
+            due = [t for t in self._transfers if t.name not in errors and t.wants_to_start(min_interval)]
+            list(executor.map(start_transfer, self._schedule(due)))
+
+        # merge the results in config order
+        output = [f"[{name}]: Skipped, another run is working on this section" for name in self._locked_out]
+        if output:
+            output.append("")
+        with self._cache_lock:
+            for t in self._transfers:
+                self._save_transfer(t)
+                output.extend(t.get_msg())
+
+            # write the cache file
+            self._write_cache()
+
+        # export metrics
+        self._write_metrics()
+
+        # notify (when polling, only if a task started or finished)
+        if notify_on_events_only and not any(t.had_events() for t in self._transfers):
+            notify = False
+        if notify and len(output):
             # optionally, email
             if self._notify_email is not None:
-                email.send_email(self._notify_email.split(","), "[Globus Sync Directory] status", "\n".join(output))
+                self._notifier.add(self._notify_email.split(","), "[Globus Sync Directory] status", "\n".join(output))
+
+        # hand this pass's messages to the background worker
+        self._notifier.flush()
+
+        return output
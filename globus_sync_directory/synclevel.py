@@ -0,0 +1,51 @@
+class SyncLevelPolicy:
+    """
+    Choose the sync level of each new transfer of a section
+
+    Transfers normally use the base level and are escalated to "checksum"
+    every `every_runs` transfers, when `every_days` days have passed since the
+    last checksum transfer, or after a failed or stalled transfer if
+    `after_failure` is set. The policy state lives in the section's cache entry.
+
+    """
+    def __init__(self, base_level, every_runs=0, every_days=0, after_failure=False):
+        self.base_level = base_level
+        self._every_runs = every_runs
+        self._every_days = every_days
+        self._after_failure = after_failure
+
+    def __repr__(self):
+        return (f"{self.base_level} (checksum every {self._every_runs} runs, every {self._every_days} days, "
+                f"after failure: {self._after_failure})")
+
+    @property
+    def escalates(self):
+        """Whether the policy ever changes the level"""
+        return self.base_level != "checksum" and bool(self._every_runs or self._every_days or self._after_failure)
+
+    def choose(self, state, now):
+        """Return the sync level to use for a transfer started now, and why"""
+        if not self.escalates:
+            return self.base_level, "configured"
+        if self._after_failure and state.get("failed"):
+            return "checksum", "previous transfer failed or stalled"
+        if self._every_runs and state.get("runs_since_checksum", 0) + 1 >= self._every_runs:
+            return "checksum", f"every {self._every_runs} runs"
+        if self._every_days:
+            last_checksum = state.get("last_checksum")
+            if last_checksum is None or now - last_checksum >= self._every_days * 86400:
+                return "checksum", f"every {self._every_days} days"
+        return self.base_level, "configured"
+
+    def submitted(self, state, level, now):
+        """Update the state after a transfer was submitted with the given level"""
+        if level == "checksum":
+            state["runs_since_checksum"] = 0
+            state["last_checksum"] = now
+        else:
+            state["runs_since_checksum"] = state.get("runs_since_checksum", 0) + 1
+        state["failed"] = False
+
+    def finished(self, state, succeeded):
+        """Update the state after a transfer finished, failed or was cancelled"""
+        state["failed"] = not succeeded
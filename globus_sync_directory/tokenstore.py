@@ -0,0 +1,77 @@
+import os
+import json
+import time
+import logging
+from pathlib import Path
+
+
+TRANSFER_RESOURCE_SERVER = "transfer.api.globus.org"
+# stop reusing a stored token this many seconds before it expires
+EXPIRY_MARGIN_SECONDS = 300
+
+
+class TokenStore:
+    """
+    On-disk cache of the transfer access token, stored next to the secret file
+
+    The file is only ever readable by the owner and is replaced atomically.
+
+    """
+    def __init__(self, secret_file, client_id):
+        self._logger = logging.getLogger("TokenStore")
+        secret_file = Path(secret_file)
+        self._path = secret_file.with_name(secret_file.name + ".tokens.json")
+        self._client_id = client_id
+
+    def load(self):
+        """Return the stored (access_token, expires_at), or (None, None) if there is no usable token"""
+        try:
+            with open(self._path) as fh:
+                data = json.load(fh)
+        except FileNotFoundError:
+            self._logger.debug(f"No token file at {self._path}")
+            return None, None
+        except (OSError, ValueError) as exc:
+            self._logger.warning(f"Ignoring unreadable token file {self._path}: {exc}")
+            return None, None
+
+        if data.get("client_id") != self._client_id:
+            self._logger.debug("Stored token belongs to a different client id")
+            return None, None
+
+        access_token = data.get("access_token")
+        expires_at = data.get("expires_at")
+        if access_token is None or expires_at is None or expires_at - EXPIRY_MARGIN_SECONDS <= time.time():
+            self._logger.debug("Stored token is missing or about to expire")
+            return None, None
+
+        self._logger.debug(f"Reusing stored access token (expires at {expires_at})")
+        return access_token, expires_at
+
+    def on_refresh(self, token_response):
+        """Authorizer callback, store the newly issued transfer token"""
+        tokens = token_response.by_resource_server[TRANSFER_RESOURCE_SERVER]
+        self.save(tokens["access_token"], tokens["expires_at_seconds"])
+
+    def save(self, access_token, expires_at):
+        """Write the token to disk, readable by the owner only"""
+        self._logger.debug(f"Writing access token to {self._path}")
+        data = {
+            "client_id": self._client_id,
+            "access_token": access_token,
+            "expires_at": expires_at,
+        }
+        tmp_path = self._path.with_name(self._path.name + ".tmp")
+        try:
+            # created readable by the owner only, so the token is never exposed
+            with open(tmp_path, "w", opener=lambda path, flags: os.open(path, flags, 0o600)) as fh:
+                json.dump(data, fh)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self._path)
+        except OSError as exc:
+            # failing to cache the token should never stop a run
+            self._logger.warning(f"Could not write token file {self._path}: {exc}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -0,0 +1,155 @@
+"""
+Timed spans of the phases of a run and of the calls to Globus, written as Chrome trace-event JSON.
+
+The file can be opened in chrome://tracing or https://ui.perfetto.dev. Tracing
+is off unless enabled, and then costs a single global lookup per span.
+
+"""
+import os
+import json
+import time
+import logging
+import functools
+import threading
+import contextlib
+
+
+_tracer = None
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class Tracer:
+    """
+    Collect complete ("X") trace events, one per span
+
+    Spans are tagged with the tags of the spans they are nested in on the same
+    thread, so a call to Globus carries the section it was made for.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._events = []
+        self._threads = {}
+        self._pid = os.getpid()
+        self._origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, category="phase", **tags):
+        """Time the body of the with statement"""
+        outer = getattr(self._local, "tags", {})
+        tags = {**outer, **tags}
+        self._local.tags = tags
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as exc:
+            error = type(exc).__name__
+            raise
+        finally:
+            end = time.perf_counter()
+            self._local.tags = outer
+            if error is not None:
+                tags = {**tags, "error": error}
+            thread = threading.current_thread()
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self._origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": self._pid,
+                "tid": thread.ident,
+                "args": {key: str(value) for key, value in tags.items()},
+            }
+            with self._lock:
+                self._events.append(event)
+                self._threads.setdefault(thread.ident, thread.name)
+
+    def write(self, path):
+        """Write the trace file"""
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        metadata = [
+            {"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": name}}
+            for tid, name in threads.items()
+        ]
+        with open(path, "w") as fh:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, fh)
+        logging.getLogger("Tracer").info(f"Wrote {len(events)} trace events to {path}")
+
+
+class TracedClient:
+    """
+    Proxy for a transfer client that records a span for every method call
+
+    """
+    def __init__(self, client, tracer):
+        self._client = client
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def traced_call(*args, **kwargs):
+            with self._tracer.span(name, category="api", **_call_endpoints(name, args, kwargs)):
+                return attr(*args, **kwargs)
+
+        return traced_call
+
+
+def _call_endpoints(name, args, kwargs):
+    """Endpoint tags of a transfer client call, where they can be told from the arguments"""
+    if name in ("submit_transfer", "submit_delete") and args:
+        data = args[0]
+        return {key: data[key] for key in ("source_endpoint", "destination_endpoint", "endpoint") if key in data}
+    if args and isinstance(args[0], str) and ("endpoint" in name or name.startswith("operation_")):
+        return {"endpoint": args[0]}
+    if "endpoint_id" in kwargs:
+        return {"endpoint": kwargs["endpoint_id"]}
+    return {}
+
+
+def enable():
+    """Start collecting spans, returning the tracer"""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def span(name, **tags):
+    """Context manager timing a phase (a shared no-op when tracing is off)"""
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, **tags)
+
+
+def traced(name):
+    """
+    Decorator recording a span for each call of a method
+
+    The span is tagged with the object's trace_tags(), if it has one.
+
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if _tracer is None:
+                return func(self, *args, **kwargs)
+            tags = self.trace_tags() if hasattr(self, "trace_tags") else {}
+            with _tracer.span(name, **tags):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def instrument(client):
+    """Wrap a transfer client so its calls are traced (the client itself when tracing is off)"""
+    if _tracer is None:
+        return client
+    return TracedClient(client, _tracer)
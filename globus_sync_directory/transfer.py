@@ -1,26 +1,48 @@
 
-import os
+import copy
+import time
 import urllib
+import posixpath
 import logging
 
 import globus_sdk
 
 from . import email
+from .concurrency import CallCache
+from .manifest import MAX_MANIFEST_ITEMS
+from .listing import iter_dir, iter_paginated
+from .sharding import partition
+from .synclevel import SyncLevelPolicy
+from .filters import PathFilter
+from .plan import TreeDiff
+from .metrics import task_elapsed, parse_time
+from .deadline import DeadlinePolicy, format_seconds
+from .status import STATUS_KEYS, snapshot_task
+from .trace import traced
 
 
 TRANSFER_FINISHED_STATUS = ("SUCCEEDED", "FAILED")
-STATUS_KEYS = [
-    "status",
-    "request_time",
-    "deadline",
-    "completion_time",
-    "directories",
-    "files",
-    "files_skipped",
-    "files_transferred",
-    "bytes_transferred",
-    "bytes_checksummed",
-]
+# what to do with a transfer that has made no progress for the stall window
+VALID_STALL_ACTIONS = ("report", "resubmit")
+# how a section with several destinations is synced: all from the source, or to the first and then on from there
+VALID_TOPOLOGIES = ("fanout", "relay")
+# task fields that change while a transfer is making progress
+PROGRESS_KEYS = ("bytes_transferred", "files_transferred", "files_skipped", "bytes_checksummed")
+# maximum number of files in a single deletion task (may be exceeded by up to one page)
+DELETE_CHUNK_SIZE = 10000
+# number of successful transfers the throughput estimate is based on
+THROUGHPUT_HISTORY = 10
+
+
+def nice_size(size_bytes):
+    """Human readable size"""
+    units = ["B", "KB", "MB", "GB", "TB", "PB"]
+    size = size_bytes
+    size_unit = units.pop(0)
+    while size >= 1024 and len(units):
+        size /= 1024
+        size_unit = units.pop(0)
+    return f"{size:.3f} {size_unit}"
 
 
 class Transfer:
@@ -28,39 +50,172 @@ class Transfer:
     A single directory sync
 
     """
-    def __init__(self, name, src_endpoint, src_path, dst_endpoint, dst_path, deadline, email, delete, sync_level):
+    def __init__(self, name, src_endpoint, src_path, dst_endpoint, dst_path, deadline, email, delete, sync_level,
+                 manifest=None, shard=1, stall_mins=0, stall_action="report", sync_policy=None,
+                 path_filter=None, skip_empty_plan=False, workers=1, extra_destinations=(), topology="fanout",
+                 watcher=None, settle_secs=0, priority=0, deadline_policy=None):
         self._logger = logging.getLogger(name)
         self._name = name
         self._src_endpoint = src_endpoint
         self._src_path = src_path
         self._dst_endpoint = dst_endpoint
         self._dst_path = dst_path
+        self._destinations = [(dst_endpoint, dst_path)] + list(extra_destinations)
+        self._topology = topology
+        self._task_dests = {}
+        self._relay_source_ids = []
+        self._watcher = watcher
+        self._settle_secs = settle_secs
+        self._priority = priority
+        self._last_succeeded = None
+        self._local_changes = None
         self._deadline = deadline
-        self._transfer_id = None
+        self._deadline_policy = deadline_policy if deadline_policy is not None else DeadlinePolicy(0)
+        self._prediction = None
+        self._prediction_stats = {}
+        self._incomplete = False
+        self._transfer_ids = []
         self._transfer_client = None
         self._client_id = None
         self._email = email
         self._delete = delete
-        self._deletion_id = None
+        self._deletion_ids = []
+        self._deletion_progress = None
+        self._checkpoint_callback = None
         self._msg = []
         self._sync_level = sync_level
+        self._sync_policy = sync_policy if sync_policy is not None else SyncLevelPolicy(sync_level)
+        self._sync_state = {}
+        self._current_sync_level = None
+        self._path_filter = path_filter if path_filter is not None else PathFilter()
+        self._filtered = None
+        self._skip_empty_plan = skip_empty_plan
+        self._workers = workers
+        self._throughput = []
         self._sent_success_email = False
+        self._notifier = None
+        self._prefetched_tasks = {}
+        self._snapshots = {}
+        self._seen_tasks = []
+        self._seen_runs = {}
+        self._manifest = manifest
+        self._shard = shard
+        self._last_started = None
+        self._had_events = False
+        self._had_failures = False
+        self._active_bytes = 0
+        self._stall_mins = stall_mins
+        self._stall_action = stall_action
+        self._progress = {}
+        self._stall_stats = {"stalls": 0, "resubmits": 0}
+        self._resubmit = False
+        self._start = True
 
     def __repr__(self):
-        return f"{self._name}: ({self._src_endpoint}:{self._src_path} -> {self._dst_endpoint}:{self._dst_path}), delete={self._delete}, sync_level={self._sync_level}"
+        return f"{self._name}: ({self._src_endpoint}:{self._src_path} -> {self._dst_endpoint}:{self._dst_path}), delete={self._delete}, sync_level={self._sync_policy}, manifest={self._manifest is not None}, shard={self._shard}, filter=({self._path_filter}), deadline={self._deadline_policy}" + \
+            (f", {self._topology} to {self._destinations[1:]}" if len(self._destinations) > 1 else "")
+
+    @property
+    def name(self):
+        """The name of the config section"""
+        return self._name
+
+    def trace_tags(self):
+        """Tags of the trace spans of this transfer"""
+        return {"section": self._name, "src_endpoint": self._src_endpoint, "dst_endpoint": self._dst_endpoint}
+
+    @property
+    def priority(self):
+        """Sections with a higher priority are started first"""
+        return self._priority
+
+    @property
+    def last_succeeded(self):
+        """When the last successful transfer finished (as seen by us), or None"""
+        return self._last_succeeded
+
+    @property
+    def src_endpoint(self):
+        """The source endpoint id"""
+        return self._src_endpoint
+
+    @property
+    def dst_endpoint(self):
+        """The destination endpoint id"""
+        return self._dst_endpoint
+
+    def set_deadline(self, deadline):
+        """Deadline given to newly submitted transfers"""
+        self._deadline = deadline
+
+    def is_busy(self):
+        """Whether a transfer or deletion is still in progress"""
+        return bool(self._transfer_ids or self._deletion_ids or self._deletion_progress is not None)
+
+    def had_events(self):
+        """Whether the last call to process started or finished a task"""
+        return self._had_events
+
+    def had_failures(self):
+        """Whether a transfer or deletion task was found to have failed in the last call to process"""
+        return self._had_failures
+
+    def active_bytes(self):
+        """Bytes transferred so far by the active transfer tasks, as of the last status check"""
+        return self._active_bytes
+
+    def stall_stats(self):
+        """Number of stalled tasks detected and resubmitted for this section"""
+        return dict(self._stall_stats)
+
+    def deadline_stats(self):
+        """Predicted and actual duration (and the time allowed) of the last transfer to finish in this run, if any"""
+        return dict(self._prediction_stats)
+
+    def throughput(self):
+        """Average bytes per second of the recent successful transfers, or None if there are none"""
+        total_bytes = sum(entry[0] for entry in self._throughput)
+        total_seconds = sum(entry[1] for entry in self._throughput)
+        if not total_bytes or not total_seconds:
+            return None
+        return total_bytes / total_seconds
+
+    def seconds_until_due(self, min_interval):
+        """Seconds until a new transfer may be started, given the minimum interval between starts"""
+        if self._last_started is None:
+            return 0
+        return max(0, self._last_started + min_interval - time.time())
 
     def set_transfer_client(self, transfer_client, client_id):
         """Reference to the transfer client"""
         self._tc = transfer_client
         self._client_id = client_id
 
-    def _check_endpoint(self, name, endpoint, path=None):
+    def start_watching(self):
+        """Start the local change watcher, if any"""
+        if self._watcher is not None:
+            self._watcher.start()
+
+    def stop_watching(self):
+        """Stop the local change watcher, if any"""
+        if self._watcher is not None:
+            self._watcher.stop()
+
+    def set_notifier(self, notifier):
+        """Queue emails on the given notifier instead of sending them straight away"""
+        self._notifier = notifier
+
+    def _check_endpoint(self, name, endpoint, path=None, call_cache=None):
         """Check a single endpoint"""
         errors = False
 
+        # route the calls through the shared cache, if any, so each endpoint is only checked once per run
+        if call_cache is None:
+            call_cache = CallCache()
+
         try:
             # try to autoactivate
-            res = self._tc.endpoint_autoactivate(endpoint)
+            res = call_cache.call(self._tc.endpoint_autoactivate, endpoint)
 
         except globus_sdk.TransferAPIError as exc:
             # pick up transfer api errors
@@ -79,7 +234,7 @@ class Transfer:
             elif path is not None:
                 # check the path exists if given
                 try:
-                    res = self._tc.operation_ls(endpoint, path=path)
+                    res = call_cache.call(self._tc.operation_ls, endpoint, path=path)
                 except globus_sdk.TransferAPIError as exc:
                     self._logger.error(f"Error listing {name} directory ({exc.code})")
                     self._logger.error(f"  {exc.message}")
@@ -87,13 +242,16 @@ class Transfer:
 
         return errors
 
-    def check_endpoints(self):
+    @traced("Transfer.check_endpoints")
+    def check_endpoints(self, call_cache=None):
         """Check the endpoints can be activated"""
         # check we can access the source endpoint and path
-        errors_src = self._check_endpoint("source", self._src_endpoint, path=self._src_path)
+        errors_src = self._check_endpoint("source", self._src_endpoint, path=self._src_path, call_cache=call_cache)
 
-        # check we can access the destination endpoint
-        errors_dst = self._check_endpoint("destination", self._dst_endpoint)
+        # check we can access the destination endpoints
+        errors_dst = False
+        for dst_endpoint, _ in self._destinations:
+            errors_dst = self._check_endpoint("destination", dst_endpoint, call_cache=call_cache) or errors_dst
 
         # return True if there were errors
         if errors_src or errors_dst:
@@ -102,144 +260,480 @@ class Transfer:
             return False
 
     def read_cache(self, cache):
-        """Reference to the cache dict"""
-        # check if set
-        if self._name in cache:
-            d = cache[self._name]
+        """Load this transfer's state from the state store, replacing any state loaded before"""
+        # everything missing from the store is reset, as the state is loaded again when a section
+        # comes back from another (overlapping) run
+        d = cache.get(self._name) or {}
+        if d:
             self._logger.debug(f"Loading cache: {d}")
-            if "transfer_id" in d:
-                self._transfer_id = d["transfer_id"]
-            if "deletion_id" in d:
-                self._deletion_id = d["deletion_id"]
-            if "sent_success_email" in d:
-                self._sent_success_email = d["sent_success_email"]
+        if "transfer_ids" in d:
+            self._transfer_ids = list(d["transfer_ids"])
+        elif "transfer_id" in d:
+            # cache written before transfers could be sharded
+            self._transfer_ids = [d["transfer_id"]]
+        else:
+            self._transfer_ids = []
+        if "deletion_ids" in d:
+            self._deletion_ids = list(d["deletion_ids"])
+        elif "deletion_id" in d:
+            # cache written before deletions were chunked
+            self._deletion_ids = [d["deletion_id"]]
+        else:
+            self._deletion_ids = []
+        self._deletion_progress = d.get("deletion_progress")
+        self._sent_success_email = d.get("sent_success_email", False)
+        self._last_started = d.get("last_started")
+        self._progress = d.get("progress", {})
+        self._sync_state = d.get("sync_policy", {})
+        self._current_sync_level = d.get("sync_level")
+        self._filtered = d.get("filtered")
+        self._throughput = d.get("throughput", [])
+        self._snapshots = d.get("snapshots", {})
+        self._last_succeeded = d.get("last_succeeded")
+        self._prediction = d.get("prediction")
+        self._incomplete = d.get("incomplete", False)
+        self._task_dests = d.get("task_dests", {})
+        self._relay_source_ids = d.get("relay_source_ids", [])
+        self._stall_stats = {"stalls": 0, "resubmits": 0, **d.get("stall_stats", {})}
 
     def set_cache(self, cache):
-        """Set cache value"""
+        """Save this transfer's state, and the tasks seen since the last save, to the state store"""
+        cache.record_tasks(self._name, self._seen_tasks)
+        self._seen_tasks = []
+        self._seen_runs = {}
+
         d = {}
-        if self._transfer_id is not None:
-            d["transfer_id"] = self._transfer_id
-        if self._deletion_id is not None:
-            d["deletion_id"] = self._deletion_id
+        if self._transfer_ids:
+            d["transfer_ids"] = self._transfer_ids
+        if self._deletion_ids:
+            d["deletion_ids"] = self._deletion_ids
+        if self._deletion_progress is not None:
+            d["deletion_progress"] = copy.deepcopy(self._deletion_progress)
         if self._sent_success_email:
             d["sent_success_email"] = self._sent_success_email
+        if self._last_started is not None:
+            d["last_started"] = self._last_started
+        if self._progress:
+            d["progress"] = self._progress
+        if self._sync_state:
+            d["sync_policy"] = self._sync_state
+        if self._transfer_ids and self._current_sync_level is not None:
+            d["sync_level"] = self._current_sync_level
+        if self._transfer_ids and self._filtered is not None:
+            d["filtered"] = self._filtered
+        if self._throughput:
+            d["throughput"] = self._throughput
+        if self._last_succeeded is not None:
+            d["last_succeeded"] = self._last_succeeded
+        if self._transfer_ids and self._prediction is not None:
+            d["prediction"] = self._prediction
+        if self._transfer_ids and self._incomplete:
+            d["incomplete"] = self._incomplete
+        if self._snapshots:
+            # the last status of the current tasks, or of the last ones if nothing is running, for --status
+            task_ids = self.get_task_ids()
+            if task_ids:
+                self._snapshots = {task_id: s for task_id, s in self._snapshots.items() if task_id in task_ids}
+            # a copy, _get_task keeps updating the snapshots while the store is written
+            d["snapshots"] = {task_id: dict(snapshot) for task_id, snapshot in self._snapshots.items()}
+        if self._transfer_ids and self._task_dests:
+            d["task_dests"] = self._task_dests
+        if self._relay_source_ids:
+            d["relay_source_ids"] = self._relay_source_ids
+        if any(self._stall_stats.values()):
+            d["stall_stats"] = self._stall_stats
 
         if len(d):
-            cache[self._name] = d
+            cache.set(self._name, d)
             self._logger.debug(f"Setting cache: {d}")
         else:
-            if self._name in cache:
-                cache.pop(self._name)
+            cache.remove(self._name)
+
+    def get_task_ids(self):
+        """Return the ids of tasks stored in the cache whose status will be checked"""
+        task_ids = list(self._transfer_ids)
+        if self._delete:
+            task_ids.extend(self._deletion_ids)
+        return task_ids
 
+    def get_seen_tasks(self):
+        """Task documents fetched since the state was last saved, with the start time of the sync each belongs to"""
+        return [(self._seen_runs.get(task_info["task_id"]), task_info) for task_info in self._seen_tasks]
+
+    def set_checkpoint(self, callback):
+        """Callback used to persist this transfer's cache entry in the middle of a run"""
+        self._checkpoint_callback = callback
+
+    def _checkpoint(self):
+        """Persist the current state, if a checkpoint callback has been set"""
+        if self._checkpoint_callback is not None:
+            self._checkpoint_callback(self)
+
+    def set_prefetched_tasks(self, tasks):
+        """Task documents fetched in bulk, keyed by task id, to use instead of calling get_task"""
+        self._prefetched_tasks = tasks
+
+    def _get_task(self, task_id):
+        """Return the task document, using the prefetched copy if there is one"""
+        # each prefetched document is only used once, later checks must see fresh data
+        task_info = self._prefetched_tasks.pop(task_id, None)
+        if task_info is None:
+            task_info = self._tc.get_task(task_id).data
+        self._seen_tasks.append(task_info)
+        self._seen_runs[task_info["task_id"]] = self._last_started
+        self._snapshots[task_id] = snapshot_task(task_info, time.time())
+        return task_info
+
+    @traced("Transfer.get_status")
     def _get_status(self):
         """Get the transfer and deletion status, if any"""
         # first get the transfer status
         self._get_transfer_status()
 
+        # delete the transferred files, resuming an interrupted deletion if there was one
+        if self._delete and self._deletion_progress is not None:
+            self._delete_source()
+
         # then get the deletion status
         self._get_deletion_status()
 
+    @traced("Transfer.get_deletion_status")
     def _get_deletion_status(self):
         """Checks for the deletion status, if one has been active"""
-        if self._delete and self._deletion_id is not None:
-            task_info = self._tc.get_task(self._deletion_id)
-
-            # message
-            msg = [f'[{self._name}]: Status of deletion with id {self._deletion_id}:']
-            for key in STATUS_KEYS:
-                msg.append(f"[{self._name}]:   {key}: {task_info[key]}")
-            self._msg.extend(msg)
-            self._msg.append("")
+        if self._delete and self._deletion_ids:
+            for deletion_id in list(self._deletion_ids):
+                task_info = self._get_task(deletion_id)
 
-            if task_info["status"] == "FAILED":
-                # print everything if failed
-                self._logger.warning("Deletion failed!")
-                for key in task_info.data.keys():
-                    self._logger.warning(f"  {key}: {task_info[key]}")
-            else:
-                for line in msg:
-                    self._logger.info(line)
+                # message
+                msg = [f'[{self._name}]: Status of deletion with id {deletion_id}:']
+                for key in STATUS_KEYS:
+                    msg.append(f"[{self._name}]:   {key}: {task_info[key]}")
+                self._msg.extend(msg)
+                self._msg.append("")
 
-            # if the deletion is finished, then remove the id
-            if task_info["status"] in TRANSFER_FINISHED_STATUS:
-                self._deletion_id = None
+                if task_info["status"] == "FAILED":
+                    # print everything if failed
+                    self._had_failures = True
+                    self._logger.warning("Deletion failed!")
+                    for key in task_info.keys():
+                        self._logger.warning(f"  {key}: {task_info[key]}")
+                else:
+                    for line in msg:
+                        self._logger.info(line)
 
+                # if the deletion is finished, then remove the id
+                if task_info["status"] in TRANSFER_FINISHED_STATUS:
+                    self._deletion_ids.remove(deletion_id)
+                    self._had_events = True
+
+    @traced("Transfer.submit_deletion")
+    def _submit_deletion(self, ddata, cursor):
+        """Submit one chunk of the deletion and checkpoint the position reached"""
+        delete_result = self._tc.submit_delete(ddata)
+        deletion_id = delete_result['task_id']
+        self._deletion_ids.append(deletion_id)
+        # only now that the chunk is submitted may a resumed run skip past it
+        self._deletion_progress = {"transfer_ids": list(cursor["transfer_ids"]), "marker": cursor["marker"]}
+        self._logger.debug(f"deletion id: {deletion_id}")
+        self._msg.append(f"[{self._name}]: Deletion started with id: {deletion_id}")
+        self._checkpoint()
+
+    @traced("Transfer.delete_source")
     def _delete_source(self):
-        """Delete files from the source share."""
-        self._logger.info("Deleting source files")
+        """
+        Delete the files that were transferred from the source share.
 
-        # create the delete data object
-        ddata = globus_sdk.DeleteData(self._tc, self._src_endpoint, recursive=True)
+        The successful transfers of the completed tasks are streamed page by
+        page and submitted in chunks of at most DELETE_CHUNK_SIZE files (plus
+        one page). The position reached is checkpointed in the cache after each
+        chunk so an interrupted run resumes where it stopped. Files written
+        after the transfer started are never deleted.
+
+        """
+        self._logger.info("Deleting source files")
+        # the cursor runs ahead of the checkpointed progress until its chunk is submitted
+        progress = {"transfer_ids": list(self._deletion_progress["transfer_ids"]),
+                    "marker": self._deletion_progress["marker"]}
+        self._checkpoint()
 
-        # get list of files and directories under the shared directory
-        # (we can't just delete the whole src_path because it could be the root (/) of the share and that will fail)
+        ddata = None
         count_delete = 0
-        for entry in self._tc.operation_ls(self._src_endpoint, path=self._src_path):
-            dpath = os.path.join(self._src_path, entry['name'])
-            self._logger.debug(f"Adding for deletion: {dpath}")
-            ddata.add_item(dpath)
-            count_delete += 1
-
-        if count_delete > 0:
-            # submit the deletion
-            delete_result = self._tc.submit_delete(ddata)
-            self._deletion_id = delete_result['task_id']
-            self._logger.debug(f"deletion id: {self._transfer_id}")
-            self._msg.append(f"[{self._name}]: Deletion started with id: {self._deletion_id}")
-        else:
+        while progress["transfer_ids"]:
+            transfer_id = progress["transfer_ids"][0]
+            res = self._tc.task_successful_transfers(transfer_id, marker=progress["marker"])
+            for item in res["DATA"]:
+                # never delete files the filter keeps on the source
+                if not self._path_filter.included_path(self._src_path, item["source_path"]):
+                    self._logger.debug(f"Not deleting filtered file: {item['source_path']}")
+                    continue
+                if ddata is None:
+                    ddata = globus_sdk.DeleteData(self._tc, self._src_endpoint, label=f"Deleting source for {self._name}")
+                self._logger.debug(f"Adding for deletion: {item['source_path']}")
+                ddata.add_item(item["source_path"])
+                count_delete += 1
+
+            # move on to the next page, or the next task
+            if res.get("next_marker"):
+                progress["marker"] = res["next_marker"]
+            else:
+                progress["transfer_ids"].pop(0)
+                progress["marker"] = None
+
+            # chunks always end on a page boundary, so the checkpoint matches what was submitted
+            if count_delete >= DELETE_CHUNK_SIZE:
+                self._submit_deletion(ddata, progress)
+                ddata = None
+                count_delete = 0
+
+        if ddata is not None:
+            self._submit_deletion(ddata, progress)
+        elif not self._deletion_ids:
             self._logger.debug("Nothing to delete")
 
+        self._deletion_progress = None
+
+    def _report_transfer(self, transfer_id, task_info, label):
+        """Report the status of a single transfer task"""
+        # message
+        msg = [f'[{self._name}]: Status of {label} with id {transfer_id}:']
+        for key in STATUS_KEYS:
+            msg.append(f"[{self._name}]:   {key}: {task_info[key]}")
+        if self._current_sync_level is not None:
+            msg.append(f"[{self._name}]:   sync_level: {self._current_sync_level}")
+        if self._path_filter:
+            msg.append(f"[{self._name}]:   filter: {self._path_filter}")
+            if self._filtered is not None:
+                msg.append(f"[{self._name}]:   files_filtered: {self._filtered['files']} "
+                           f"({self._filtered['bytes']} bytes, {self._filtered['directories']} directories)")
+        self._msg.extend(msg)
+        self._msg.append("")
+
+        # print to standard output
+        if task_info["status"] == "FAILED" or (task_info["is_ok"] is not None and not task_info["is_ok"]):
+            # print everything if failed
+            self._logger.warning("Transfer failed!")
+            for key in task_info.keys():
+                self._logger.warning(f"  {key}: {task_info[key]}")
+
+            # also print task event list if failed
+            fail_count = 0
+            for event in iter_paginated(self._tc.task_event_list, transfer_id, limit=10):
+                if event["is_error"]:
+                    line = f"{event['time']}: {event['DATA_TYPE']}: {event['code']} ({event['description']}): {event['details']}"
+                    self._msg.append(line)
+                    self._logger.warning(line)
+                    fail_count += 1
+                if fail_count >= 2:  # print last two (one for deadline, one for actual error?)
+                    break
+            if fail_count > 0:
+                self._msg.append("")
+        else:
+            for line in msg:
+                self._logger.info(line)
+
+    @traced("Transfer.get_transfer_status")
     def _get_transfer_status(self):
-        """Checks for an active transfer, reports info"""
-        if self._transfer_id is not None:
-            # info about transfer
-            task_info = self._tc.get_task(self._transfer_id)
-
-            # message
-            msg = [f'[{self._name}]: Status of transfer with id {self._transfer_id}:']
-            for key in STATUS_KEYS:
-                msg.append(f"[{self._name}]:   {key}: {task_info[key]}")
-            self._msg.extend(msg)
-            self._msg.append("")
+        """Checks for active transfers (one per shard and destination), reports info"""
+        if self._transfer_ids:
+            num_shards = len(self._transfer_ids)
+            tasks = []
+            for i, transfer_id in enumerate(self._transfer_ids):
+                # info about transfer
+                task_info = self._get_task(transfer_id)
+                tasks.append(task_info)
+                label = "transfer" if num_shards == 1 else f"transfer task {i + 1}/{num_shards}"
+                if len(self._destinations) > 1:
+                    dest = self._task_dests.get(transfer_id, 0)
+                    label += f" to destination {dest + 1}/{len(self._destinations)} ({self._destinations[dest][0]})"
+                self._report_transfer(transfer_id, task_info, label)
 
-            # print to standard output
-            if task_info["status"] == "FAILED" or (task_info["is_ok"] is not None and not task_info["is_ok"]):
-                # print everything if failed
-                self._logger.warning("Transfer failed!")
-                for key in task_info.data.keys():
-                    self._logger.warning(f"  {key}: {task_info[key]}")
-
-                # also print task event list if failed
-                fail_count = 0
-                for event in self._tc.paginated.task_event_list(self._transfer_id, limit=10).items():
-                    if event["is_error"]:
-                        line = f"{event['time']}: {event['DATA_TYPE']}: {event['code']} ({event['description']}): {event['details']}"
-                        self._msg.append(line)
-                        self._logger.warning(line)
-                        fail_count += 1
-                    if fail_count >= 2:  # print last two (one for deadline, one for actual error?)
-                        break
-                if fail_count > 0:
-                    self._msg.append("")
-            else:
-                for line in msg:
-                    self._logger.info(line)
+            # look for tasks that have stopped making progress
+            if self._check_stalled(tasks):
+                return
+
+            # wait until every shard has finished before acting on the result
+            statuses = [task_info["status"] for task_info in tasks]
+            self._active_bytes = sum(task_info["bytes_transferred"] or 0 for task_info in tasks if task_info["status"] == "ACTIVE")
+            if num_shards > 1:
+                line = f"[{self._name}]: {statuses.count('SUCCEEDED')}/{num_shards} tasks succeeded, {statuses.count('FAILED')} failed"
+                self._logger.info(line)
+                self._msg.append(line)
+                self._msg.append("")
+            if not all(status in TRANSFER_FINISHED_STATUS for status in statuses):
+                return
+            succeeded = all(status == "SUCCEEDED" for status in statuses)
+            if succeeded and self._incomplete:
+                # some of the tasks of this sync could not be submitted
+                self._logger.warning("Not every task of the transfer was submitted, treating it as failed")
+                self._msg.append(f"[{self._name}]: Not every task of the transfer was submitted, treating it as failed")
+                succeeded = False
+            task_info = tasks[0] if num_shards == 1 else self._combine_tasks(tasks)
+
+            # a relay continues from the first destination once it has everything
+            if succeeded and self._topology == "relay" and len(self._destinations) > 1 and not self._relay_source_ids:
+                self._record_throughput(tasks)
+                self._relay()
+                return
+
+            # compare the outcome with the prediction it was submitted with
+            self._report_prediction(tasks, "succeeded" if succeeded else "failed")
+
+            # a failure may escalate the sync level of the next transfer
+            self._sync_policy.finished(self._sync_state, succeeded)
+            if not succeeded:
+                self._had_failures = True
+
+            # the source manifest (and local changes) only count as synced if the transfer succeeded
+            if self._manifest is not None:
+                if succeeded:
+                    self._manifest.commit()
+                else:
+                    self._manifest.discard()
+            if self._watcher is not None:
+                if succeeded:
+                    self._watcher.commit()
+                else:
+                    self._watcher.discard()
 
             # if successful
-            if task_info["status"] == "SUCCEEDED":
+            if succeeded:
+                self._last_succeeded = time.time()
+
+                # remember how fast it went, to estimate how long future transfers will take
+                if not self._relay_source_ids:
+                    self._record_throughput(tasks)
+
                 # we send an email the first time the transfer succeeded, or if more files were transferred later
                 if self._email is not None and (task_info["files_transferred"] > 0 or not self._sent_success_email):
                     self._send_email(task_info)
                     self._sent_success_email = True
 
-                # start a deletion job
+                # queue deletion of the transferred files, now that every destination has them
                 if self._delete:
-                    self._delete_source()
+                    source_ids = self._relay_source_ids or [
+                        transfer_id for transfer_id in self._transfer_ids if self._task_dests.get(transfer_id, 0) == 0
+                    ]
+                    self._deletion_progress = {"transfer_ids": source_ids, "marker": None}
+
+            # the transfer is finished, so remove the ids
+            self._transfer_ids = []
+            self._task_dests = {}
+            self._relay_source_ids = []
+            self._progress = {}
+            self._filtered = None
+            self._prediction = None
+            self._incomplete = False
+            self._had_events = True
+
+    def _record_throughput(self, tasks):
+        """Add the bytes and time taken by the tasks from the source to the first destination to the history"""
+        tasks = [task_info for task_info in tasks if self._task_dests.get(task_info["task_id"], 0) == 0]
+        total_bytes = sum(task_info["bytes_transferred"] or 0 for task_info in tasks)
+        elapsed = max((task_elapsed(task_info) or 0 for task_info in tasks), default=0)
+        if total_bytes and elapsed:
+            self._throughput = (self._throughput + [[total_bytes, elapsed, self._current_sync_level]])[-THROUGHPUT_HISTORY:]
+
+    def _report_prediction(self, tasks, outcome):
+        """Log the predicted duration of a finished (or cancelled) transfer next to the actual one"""
+        if self._prediction is None:
+            return
+        # bytes moved to a single destination (every destination gets the same data)
+        dest_bytes = {}
+        for task_info in tasks:
+            dest = self._task_dests.get(task_info["task_id"], 0)
+            dest_bytes[dest] = dest_bytes.get(dest, 0) + (task_info["bytes_transferred"] or 0)
+        actual_bytes = max(dest_bytes.values(), default=0)
+        ends = [parse_time(task_info.get("completion_time")) for task_info in tasks]
+        ends = [end.timestamp() for end in ends if end is not None]
+        actual_seconds = (max(ends) if len(ends) == len(tasks) else time.time()) - self._prediction["submitted"]
+
+        predicted_seconds = self._prediction["seconds"]
+        line = (f"[{self._name}]: Transfer {outcome} in {format_seconds(actual_seconds)} ({nice_size(actual_bytes)}), "
+                f"predicted {format_seconds(predicted_seconds)} ({nice_size(self._prediction['bytes'])}), "
+                f"allowed {format_seconds(self._prediction['allowed'])}")
+        self._logger.info(line)
+        self._msg.append(line)
+        self._prediction_stats = {
+            "predicted_seconds": predicted_seconds,
+            "actual_seconds": actual_seconds,
+            "deadline_seconds": self._prediction["allowed"],
+        }
+        self._prediction = None
+
+    def _check_stalled(self, tasks):
+        """
+        Track the progress of the active tasks across polls and handle stalled ones
+
+        A task is stalled when none of its PROGRESS_KEYS changed for longer than
+        the stall window. Returns True if the transfer was cancelled so it can be
+        resubmitted.
+
+        """
+        now = time.time()
+        stalled = []
+        progress = {}
+        for task_info in tasks:
+            task_id = task_info["task_id"]
+            if task_info["status"] != "ACTIVE":
+                continue
+            values = [task_info[key] or 0 for key in PROGRESS_KEYS]
+            previous = self._progress.get(task_id)
+            if previous is None or previous["values"] != values:
+                progress[task_id] = {"values": values, "changed": now, "stalled": False}
+            else:
+                progress[task_id] = previous
+            if self._stall_mins > 0 and now - progress[task_id]["changed"] > 60 * self._stall_mins:
+                stalled.append(task_info)
+        self._progress = progress
+
+        for task_info in stalled:
+            record = progress[task_info["task_id"]]
+            minutes = (now - record["changed"]) / 60
+            line = (f"[{self._name}]: Transfer {task_info['task_id']} stalled: no progress for {minutes:.0f} minutes "
+                    f"({task_info['bytes_transferred']} bytes, {task_info['files_transferred']} files transferred)")
+            self._logger.warning(line)
+            self._msg.append(line)
+            if not record["stalled"]:
+                record["stalled"] = True
+                self._stall_stats["stalls"] += 1
 
-            # if the transfer is finished, then remove the id
-            if task_info["status"] in TRANSFER_FINISHED_STATUS:
-                self._transfer_id = None
+        if stalled:
+            self._msg.append(f"[{self._name}]:   stalls: {self._stall_stats['stalls']}, resubmits: {self._stall_stats['resubmits']}")
+            self._msg.append("")
+
+        # cancel every shard and start again, unless we are only reporting
+        if not stalled or self._stall_action != "resubmit" or not self._start:
+            return False
+        for transfer_id in self._transfer_ids:
+            self._logger.warning(f"Cancelling transfer {transfer_id}")
+            self._tc.cancel_task(transfer_id)
+        self._msg.append(f"[{self._name}]: Cancelled stalled transfer, resubmitting")
+        self._report_prediction(tasks, "stalled")
+        if self._manifest is not None:
+            self._manifest.discard()
+        if self._watcher is not None:
+            self._watcher.discard()
+        self._stall_stats["resubmits"] += 1
+        self._sync_policy.finished(self._sync_state, False)
+        self._transfer_ids = []
+        self._task_dests = {}
+        self._relay_source_ids = []
+        self._progress = {}
+        self._incomplete = False
+        self._resubmit = True
+        self._had_events = True
+        return True
 
+    @staticmethod
+    def _combine_tasks(tasks):
+        """Combine the task documents of several shards into one summary"""
+        combined = dict(tasks[0])
+        for key in ("directories", "files", "files_skipped", "files_transferred", "bytes_transferred", "bytes_checksummed"):
+            combined[key] = sum(task_info[key] or 0 for task_info in tasks)
+        combined["status"] = "SUCCEEDED" if all(t["status"] == "SUCCEEDED" for t in tasks) else "FAILED"
+        return combined
+
+    @traced("Transfer.send_email")
     def _send_email(self, task_info):
         """Send email if successful and files were transferred"""
         self._logger.debug(f"Creating email to send to: {self._email}")
@@ -251,15 +745,6 @@ class Transfer:
                 'origin_path': self._dst_path,
             })
 
-        def nice_size(size_bytes):
-            units = ["B", "KB", "MB", "GB", "TB", "PB"]
-            size = size_bytes
-            size_unit = units.pop(0)
-            while size >= 1024 and len(units):
-                size /= 1024
-                size_unit = units.pop(0)
-            return f"{size:.3f} {size_unit}"
-
         msg = [
             f"Source endpoint: {task_info['source_endpoint_display_name']}",
             f"Source path: {self._src_path}",
@@ -272,53 +757,377 @@ class Transfer:
             f"View transferred files here: {url_string}",
         ]
         self._logger.debug("Sending email:\n" + "\n".join(msg))
-        email.send_email(self._email.split(","), subject, "\n".join(msg))
+        if self._notifier is not None:
+            self._notifier.add(self._email.split(","), subject, "\n".join(msg))
+        else:
+            email.send_email(self._email.split(","), subject, "\n".join(msg))
 
     def get_msg(self):
         """Return the message"""
         return self._msg
 
-    def process(self, start=True):
+    def report_error(self, action, exc):
+        """An unexpected error stopped processing this transfer in this pass (call from the except block)"""
+        self._logger.exception(f"Error while {action}")
+        self._msg.append(f"[{self._name}]: ERROR while {action}: {exc}")
+        self._msg.append("")
+        self._had_failures = True
+
+    def process(self, start=True, min_interval=0):
         """Process the transfer or print status if already active"""
+        self.update(start=start)
+        if self.wants_to_start(min_interval):
+            self.start_new()
+
+    @traced("Transfer.update")
+    def update(self, start=True):
+        """Check (and act on) the status of the current tasks, the first half of process"""
         self._logger.info(f"Processing: {self._name}")
+        self._had_events = False
+        self._had_failures = False
+        self._active_bytes = 0
+        self._resubmit = False
+        self._start = start
 
         # if there was an id stored in the cache, check if it is active
         self._msg = [f"[{self._name}]: Checking status of current transfer (if any)..."]
         self._get_status()
 
-        # start a new transfer if:
-        #  - there isn't a transfer already running
-        #  - there isn't a deletion already running
-        #  - command line options allow us to
-        if self._transfer_id is None and self._deletion_id is None and start:
-            # start a new transfer
-            self._msg.append(f"[{self._name}]: Starting new transfer...")
-            self._transfer()
+    def wants_to_start(self, min_interval=0):
+        """
+        Whether a new transfer should be started, after a call to update
 
-            # check status of newly started transfer
-            self._msg.append(f"[{self._name}]: Checking status of started transfer...")
-            self._get_status()
+        A new transfer is started if:
+         - there isn't a transfer already running
+         - there isn't a deletion already running
+         - command line options allow us to
+         - at least min_interval seconds have passed since the last one was started
+           (a stalled transfer that was cancelled is restarted straight away)
+         - with a local watcher, something changed and the writes have stopped
 
-    def _transfer(self):
-        """Start the transfer"""
-        # initiate the data transfer to NeSI
+        """
+        if self.is_busy() or not self._start:
+            return False
+        if not self._resubmit and self.seconds_until_due(min_interval) > 0:
+            return False
+        if self._watcher is not None and not self._resubmit and not self._local_changes_settled():
+            return False
+        return True
+
+    def tasks_per_start(self):
+        """Number of tasks submitted at once by a new transfer"""
+        return self._shard * (len(self._destinations) if self._topology == "fanout" else 1)
+
+    def defer(self, reason):
+        """A new transfer is due but will not be started in this pass"""
+        self._logger.info(f"Deferring new transfer: {reason}")
+        self._msg.append(f"[{self._name}]: New transfer deferred: {reason}")
+
+    @traced("Transfer.start_new")
+    def start_new(self):
+        """Start a new transfer, the second half of process"""
+        # optionally, compare the source with the destination first and skip if in sync
+        if self._skip_empty_plan and not self._resubmit and self._plan_is_empty():
+            return
+
+        # start a new transfer
+        self._msg.append(f"[{self._name}]: Starting new transfer...")
+        self._transfer()
+
+        # check status of newly started transfer
+        self._msg.append(f"[{self._name}]: Checking status of started transfer...")
+        self._get_status()
+
+    @traced("Transfer.plan")
+    def plan(self):
+        """
+        Work out what a new sync would transfer, without submitting anything
+
+        Returns the counts from comparing the source and destination trees at
+        the sync level the next transfer would use, and the estimated duration
+        (None without any throughput history).
+
+        """
+        sync_level, reason = self._sync_policy.choose(self._sync_state, time.time())
+        self._logger.info(f"Planning {sync_level} sync ({reason})")
+        result = TreeDiff(self._tc, self._workers).diff(self._src_endpoint, self._src_path, self._dst_endpoint,
+                                                        self._dst_path, sync_level, self._path_filter or None)
+        result["sync_level"] = sync_level
+        throughput = self.throughput()
+        result["throughput"] = throughput
+        if throughput is None:
+            result["eta_seconds"] = None
+        else:
+            # checksum syncs read every file that might be unchanged, roughly at the transfer rate
+            result["eta_seconds"] = (result["bytes"] + result["bytes_to_verify"]) / throughput
+        return result
+
+    def _plan_is_empty(self):
+        """Whether a new sync would find nothing to transfer (the start of the next sync is then pushed back)"""
+        try:
+            result = self.plan()
+        except globus_sdk.TransferAPIError as exc:
+            self._logger.warning(f"Could not plan the sync, starting it anyway ({exc.code}): {exc.message}")
+            return False
+        if result["files"] or result["files_to_verify"]:
+            return False
+        self._logger.info("Destination already in sync, not starting a transfer")
+        self._msg.append(f"[{self._name}]: Destination already in sync, not starting a transfer")
+        self._last_started = time.time()
+        return True
+
+    @traced("Transfer.local_changes_settled")
+    def _local_changes_settled(self):
+        """Whether the local source has changes and has been quiet for the settle time"""
+        changed, last_change = self._watcher.pending()
+        if not changed:
+            self._logger.info("No changes below local_path, not starting a transfer")
+            self._msg.append(f"[{self._name}]: No local changes, not starting a transfer")
+            return False
+        wait = self._settle_secs - (time.time() - last_change)
+        if wait > 0:
+            self._logger.info(f"{len(changed)} changed directories, waiting {wait:.0f}s for writes to settle")
+            self._msg.append(f"[{self._name}]: {len(changed)} directories changed locally, waiting {wait:.0f}s for writes to settle")
+            return False
+        self._local_changes = changed
+        return True
+
+    @traced("Transfer.changed_items")
+    def _changed_items(self):
+        """
+        Return the (source, destination, recursive) items to transfer, based on the local watcher or source manifest
+
+        An empty list means nothing has changed since the last successful sync.
+
+        """
+        items = [(self._src_path, self._dst_path, True)]
+        if self._watcher is not None and self._local_changes is not None:
+            changed = self._local_changes
+            self._watcher.begin()
+            self._logger.info(f"{len(changed)} locally changed subtrees")
+            if "" in changed or len(changed) > MAX_MANIFEST_ITEMS:
+                return items
+            return [(posixpath.join(self._src_path, rel), posixpath.join(self._dst_path, rel), True) for rel in changed]
+        if self._manifest is None:
+            return items
+
+        try:
+            dirs = self._manifest.build(self._tc, self._src_endpoint, self._src_path)
+        except globus_sdk.TransferAPIError as exc:
+            self._logger.warning(f"Could not build source manifest, syncing everything ({exc.code}): {exc.message}")
+            return items
+        if self._path_filter:
+            self._filtered = dict(self._manifest.filtered)
+
+        changed = self._manifest.changed_paths(dirs)
+        self._logger.info(f"{len(changed)} changed subtrees since the last successful sync")
+        if not changed:
+            self._manifest.discard()
+            return []
+        if "" in changed or len(changed) > MAX_MANIFEST_ITEMS:
+            return items
+
+        return [(posixpath.join(self._src_path, rel), posixpath.join(self._dst_path, rel), True) for rel in changed]
+
+    @traced("Transfer.shard_items")
+    def _shard_items(self, items):
+        """Split the items to transfer into balanced shards, weighted by size"""
+        # a single directory is split by its top level entries
+        if len(items) == 1 and items[0][2]:
+            src_root, dst_root, _ = items[0]
+            entries = []
+            for e in iter_dir(self._tc, self._src_endpoint, src_root):
+                # filter rules only apply below the items, so apply them to the top level ourselves
+                if self._path_filter.included(e["name"], e["type"] == "dir"):
+                    entries.append(e)
+                elif self._manifest is None:
+                    # (the manifest has already counted them)
+                    if e["type"] == "dir":
+                        self._filtered["directories"] += 1
+                    else:
+                        self._filtered["files"] += 1
+                        self._filtered["bytes"] += e["size"]
+            items = [(posixpath.join(src_root, e["name"]), posixpath.join(dst_root, e["name"]), e["type"] == "dir") for e in entries]
+            sizes = [None if e["type"] == "dir" else e["size"] for e in entries]
+        else:
+            sizes = [None if recursive else 0 for _, _, recursive in items]
+
+        # directory sizes come from the manifest if there is one
+        if self._manifest is not None:
+            rels = [posixpath.relpath(src, self._src_path) for src, _, _ in items]
+            rels = ["" if rel == "." else rel for rel in rels]
+            subtree_sizes = self._manifest.subtree_sizes(rels)
+            sizes = [subtree_sizes[rel] if size is None else size for rel, size in zip(rels, sizes)]
+
+        # otherwise assume directories are of average size
+        known = [size for size in sizes if size is not None]
+        default_size = max(1, sum(known) // len(known)) if known else 1
+        weights = [default_size if size is None else size for size in sizes]
+
+        return partition(items, weights, self._shard)
+
+    def _dst_path_for(self, dest, dst_path):
+        """Map a path below the first destination to the same path below another destination"""
+        if dest == 0:
+            return dst_path
+        rel = posixpath.relpath(dst_path, self._dst_path)
+        dst_root = self._destinations[dest][1]
+        return dst_root if rel == "." else posixpath.join(dst_root, rel)
+
+    @traced("Transfer.submit_transfer")
+    def _submit_transfer(self, src_endpoint, dst_endpoint, items, label, dest):
+        """Submit a single transfer task and track it"""
         tdata = globus_sdk.TransferData(
             self._tc,
-            self._src_endpoint,
-            self._dst_endpoint,
-            label=f"Syncing data for {self._name}",
-            sync_level=self._sync_level,
-            deadline=self._deadline,
+            src_endpoint,
+            dst_endpoint,
+            label=label,
+            sync_level=self._current_sync_level,
+            deadline=self._submission_deadline(),
         )
 
-        # add the directory to the transfer
-        tdata.add_item(self._src_path, self._dst_path, recursive=True)
+        # leave out transient and scratch files
+        self._path_filter.add_rules(tdata)
+
+        # add the files and directories to the transfer
+        for src_path, dst_path, recursive in items:
+            self._logger.debug(f"Adding for transfer: {src_path} -> {dst_path}")
+            tdata.add_item(src_path, dst_path, recursive=recursive)
 
         # actually start the transfer
         transfer_result = self._tc.submit_transfer(tdata)
-        self._transfer_id = transfer_result["task_id"]
-        self._logger.info(f"transfer id: {self._transfer_id}")
-        self._msg.append(f"[{self._name}]: Transfer started with id: {self._transfer_id}")
+        transfer_id = transfer_result["task_id"]
+        self._transfer_ids.append(transfer_id)
+        if len(self._destinations) > 1:
+            self._task_dests[transfer_id] = dest
+        self._logger.info(f"transfer id: {transfer_id}")
+        self._msg.append(f"[{self._name}]: Transfer started with id: {transfer_id}")
+
+        # record the task straight away, so it is not submitted again if the run dies
+        self._checkpoint()
+
+    def _submit_all(self, submissions):
+        """
+        Submit the tasks of a sync, given as _submit_transfer arguments
+
+        If a submission fails, the tasks already submitted are kept (each was
+        checkpointed) and carry on, but the sync is marked incomplete so it
+        does not count as successful when they finish.
+
+        """
+        try:
+            for args in submissions:
+                self._submit_transfer(*args)
+        except Exception:
+            if self._transfer_ids:
+                self._incomplete = True
+                self._checkpoint()
+            else:
+                # nothing was submitted, the changes are still to be synced
+                if self._manifest is not None:
+                    self._manifest.discard()
+                if self._watcher is not None:
+                    self._watcher.discard()
+            raise
+
+    def _submission_deadline(self):
+        """Deadline for a task submitted now: the global one, or from the prediction if deadlines are adaptive"""
+        if self._deadline_policy.adaptive and self._prediction is not None:
+            return self._deadline_policy.deadline(self._prediction, time.time())
+        return self._deadline
+
+    @traced("Transfer.relay")
+    def _relay(self):
+        """The first destination has everything, sync the other destinations from it"""
+        self._logger.info("First destination complete, relaying to the other destinations")
+        self._msg.append(f"[{self._name}]: First destination complete, relaying to the other destinations")
+        self._relay_source_ids = list(self._transfer_ids)
+        self._transfer_ids = []
+        self._task_dests = {}
+        self._progress = {}
+        relay_endpoint, relay_root = self._destinations[0]
+        submissions = []
+        for dest in range(1, len(self._destinations)):
+            dst_endpoint, dst_root = self._destinations[dest]
+            label = f"Syncing data for {self._name} to destination {dest + 1} (relay)"
+            submissions.append((relay_endpoint, dst_endpoint, [(relay_root, dst_root, True)], label, dest))
+        self._submit_all(submissions)
+        self._msg.append("")
+        self._had_events = True
+
+    @traced("Transfer.transfer")
+    def _transfer(self):
+        """Start the transfer"""
+        self._last_started = time.time()
+        self._had_events = True
+
+        # work out what needs transferring
+        self._filtered = None
+        items = self._changed_items()
+        if not items:
+            self._logger.info("Source unchanged since the last successful sync, not starting a transfer")
+            self._msg.append(f"[{self._name}]: Source unchanged since the last successful sync, not starting a transfer")
+            return
+
+        # files filtered out are only counted when the source is listed (manifest or sharding)
+        if self._path_filter and self._filtered is None and self._shard > 1 and self._manifest is None:
+            self._filtered = {"files": 0, "directories": 0, "bytes": 0}
+
+        # optionally split the transfer into several tasks
+        shards = self._shard_items(items) if self._shard > 1 else [items]
+        if not shards:
+            self._logger.info("Nothing to transfer (the source is empty or everything is filtered out), not starting a transfer")
+            self._msg.append(f"[{self._name}]: Nothing to transfer (the source is empty or everything is filtered out), "
+                             f"not starting a transfer")
+            # which is as good as a successful sync of the changes
+            if self._manifest is not None:
+                self._manifest.commit()
+            if self._watcher is not None:
+                self._watcher.commit()
+            return
+
+        # pick the sync level for this run
+        now = time.time()
+        self._current_sync_level, reason = self._sync_policy.choose(self._sync_state, now)
+        self._logger.info(f"sync level: {self._current_sync_level} ({reason})")
+        self._msg.append(f"[{self._name}]: Using sync level {self._current_sync_level} ({reason})")
+
+        # predict how long it will take from the recent transfers, for an adaptive deadline and to check the model
+        self._prediction = self._deadline_policy.predict(self._throughput, self._current_sync_level)
+        if self._prediction is not None:
+            self._prediction["allowed"] = self._deadline_policy.allowed_seconds(self._prediction)
+            self._prediction["submitted"] = now
+            line = (f"[{self._name}]: Predicted {format_seconds(self._prediction['seconds'])} "
+                    f"({nice_size(self._prediction['bytes'])}), allowing {format_seconds(self._prediction['allowed'])}")
+            self._logger.info(line)
+            self._msg.append(line)
+
+        # a fanout sends everything from the source to each destination, a relay only to the first one
+        self._task_dests = {}
+        self._relay_source_ids = []
+        self._incomplete = False
+        submissions = []
+        num_dests = len(self._destinations) if self._topology == "fanout" else 1
+        for dest in range(num_dests):
+            dst_endpoint, dst_root = self._destinations[dest]
+            for i, shard_items in enumerate(shards):
+                label = f"Syncing data for {self._name}"
+                if len(shards) > 1:
+                    label += f" (shard {i + 1} of {len(shards)})"
+                if len(self._destinations) > 1:
+                    label += f" to destination {dest + 1}"
+
+                # items are worked out against the first destination
+                shard_items = [
+                    (src_path, self._dst_path_for(dest, dst_path), recursive) for src_path, dst_path, recursive in shard_items
+                ]
+                submissions.append((self._src_endpoint, dst_endpoint, shard_items, label, dest))
+        try:
+            self._submit_all(submissions)
+        finally:
+            # only a sync that was actually submitted counts towards (or resets) the escalation
+            if self._transfer_ids:
+                self._sync_policy.submitted(self._sync_state, self._current_sync_level, now)
 
         # print url for viewing changes
         url_string = 'https://app.globus.org/file-manager?' + \
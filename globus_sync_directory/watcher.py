@@ -0,0 +1,291 @@
+import os
+import re
+import json
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import posixpath
+import threading
+from pathlib import Path
+
+
+WATCHER_BACKENDS = ("auto", "inotify", "poll")
+DEFAULT_SETTLE_SECS = 300
+
+# inotify event masks (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def minimal_subtrees(rels):
+    """Drop the paths that are below another path in the set"""
+    result = []
+    for rel in sorted(rels, key=lambda rel: (rel.count("/"), rel)):
+        if not any(rel == top or top == "" or rel.startswith(top + "/") for top in result):
+            result.append(rel)
+    return sorted(result)
+
+
+class PollingWatcher:
+    """
+    Find the directories below a local path that changed since the last successful sync, by scanning it
+
+    Each directory is fingerprinted from the names, sizes and mtimes of its
+    entries. The fingerprints of the scan being transferred are stored as
+    pending and promoted to synced once the transfer succeeds, so changes are
+    also picked up between separate runs.
+
+    """
+    def __init__(self, local_path, directory, name, path_filter=None):
+        self._logger = logging.getLogger(name)
+        self._local_path = Path(local_path)
+        self._path_filter = path_filter
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+        self._dir = Path(directory)
+        self._synced_path = self._dir / f"{safe_name}.local.json"
+        self._pending_path = self._dir / f"{safe_name}.local.pending.json"
+        self._scan = None
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def _included(self, rel, is_dir):
+        return self._path_filter is None or self._path_filter.included(rel, is_dir)
+
+    def _scan_tree(self):
+        """Return the fingerprint and newest mtime of every directory"""
+        dirs = {}
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            own = hashlib.sha1()
+            newest = 0.0
+            try:
+                with os.scandir(self._local_path / rel) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+                    for entry in entries:
+                        child = posixpath.join(rel, entry.name)
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if not self._included(child, is_dir):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                        newest = max(newest, st.st_mtime)
+                        if is_dir:
+                            own.update(f"d {entry.name}\n".encode())
+                            stack.append(child)
+                        else:
+                            own.update(f"f {entry.name} {st.st_size} {st.st_mtime_ns}\n".encode())
+            except FileNotFoundError:
+                # removed while scanning, the parent shows up as changed
+                continue
+            dirs[rel] = [own.hexdigest(), newest]
+        return dirs
+
+    def _load_synced(self):
+        if self._synced_path.exists():
+            with open(self._synced_path) as fh:
+                return json.load(fh)
+        return {}
+
+    def pending(self):
+        """Return the changed directories (relative to the local path) and the time of the last change"""
+        self._scan = self._scan_tree()
+        synced = self._load_synced()
+        changed = set()
+        last_change = 0.0
+        for rel, (fingerprint, newest) in self._scan.items():
+            old = synced.get(rel)
+            if old is None or old[0] != fingerprint:
+                changed.add(rel)
+                last_change = max(last_change, newest)
+        for rel in synced:
+            if rel not in self._scan:
+                # removed directory, its parent has changed
+                changed.add(posixpath.dirname(rel))
+        return minimal_subtrees(changed), last_change
+
+    def begin(self):
+        """A transfer of the pending changes is being submitted, store the scan it is based on"""
+        if self._scan is not None:
+            # on disk, as the transfer may only finish in a later run
+            self._dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._pending_path.with_name(self._pending_path.name + ".tmp")
+            with open(tmp_path, "w") as fh:
+                json.dump(self._scan, fh)
+            os.replace(tmp_path, self._pending_path)
+
+    def commit(self):
+        """The transfer succeeded, the scan it was based on becomes the synced one"""
+        if self._pending_path.exists():
+            os.replace(self._pending_path, self._synced_path)
+
+    def discard(self):
+        """The transfer failed, the changes are still pending"""
+        if self._pending_path.exists():
+            self._pending_path.unlink()
+
+
+class InotifyWatcher:
+    """
+    Record the directories below a local path that change, using inotify (Linux only)
+
+    A background thread watches every directory and notes the time of the
+    last event in each. Changes made while the watcher was not running are
+    unknown, so it starts with the whole tree pending.
+
+    """
+    def __init__(self, local_path, name, path_filter=None):
+        self._logger = logging.getLogger(name)
+        self._local_path = Path(local_path)
+        self._path_filter = path_filter
+        self._lock = threading.Lock()
+        self._dirty = {"": 0.0}
+        self._in_flight = {}
+        self._wds = {}
+        self._fd = None
+        self._thread = None
+        self._stop = threading.Event()
+
+        libc_name = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+    def _add_watches(self, rel):
+        """Watch a directory and everything below it"""
+        for dirpath, dirnames, _ in os.walk(self._local_path / rel):
+            dir_rel = os.path.relpath(dirpath, self._local_path)
+            dir_rel = "" if dir_rel == "." else dir_rel
+            dirnames[:] = [d for d in dirnames
+                           if self._path_filter is None or self._path_filter.included(posixpath.join(dir_rel, d), True)]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                self._logger.warning(f"Cannot watch {dirpath}: {os.strerror(err)}")
+                continue
+            self._wds[wd] = dir_rel
+
+    def start(self):
+        """Start watching in the background"""
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._add_watches("")
+        self._logger.info(f"Watching {len(self._wds)} directories below {self._local_path}")
+        self._thread = threading.Thread(target=self._run, name="InotifyWatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _mark(self, rel):
+        with self._lock:
+            self._dirty[rel] = time.time()
+
+    def _run(self):
+        """Read events until stopped"""
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._fd], [], [], 1.0)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+                offset += EVENT_HEADER.size + length
+                self._handle(wd, mask, os.fsdecode(name))
+
+    def _handle(self, wd, mask, name):
+        """Record a single event"""
+        if mask & IN_Q_OVERFLOW:
+            # events were lost, anything may have changed
+            self._mark("")
+            return
+        if mask & IN_IGNORED:
+            self._wds.pop(wd, None)
+            return
+        rel = self._wds.get(wd)
+        if rel is None:
+            return
+        is_dir = bool(mask & IN_ISDIR)
+        child = posixpath.join(rel, name) if name else rel
+        if name and self._path_filter is not None and not self._path_filter.included(child, is_dir):
+            return
+        if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+            # a new directory (maybe already with files in it)
+            self._add_watches(child)
+            self._mark(child)
+        else:
+            self._mark(rel)
+
+    def pending(self):
+        """Return the changed directories (relative to the local path) and the time of the last change"""
+        with self._lock:
+            return minimal_subtrees(self._dirty), max(self._dirty.values(), default=0.0)
+
+    def begin(self):
+        """A transfer of the pending changes is being submitted, later events are pending again"""
+        with self._lock:
+            self._in_flight, self._dirty = self._dirty, {}
+
+    def commit(self):
+        """The transfer succeeded"""
+        with self._lock:
+            self._in_flight = {}
+
+    def discard(self):
+        """The transfer failed, the changes it covered are pending again"""
+        with self._lock:
+            for rel, changed in self._in_flight.items():
+                self._dirty[rel] = max(changed, self._dirty.get(rel, 0.0))
+            self._in_flight = {}
+
+
+def create_watcher(backend, local_path, directory, name, path_filter=None, long_running=False):
+    """
+    Create a watcher for a local source directory
+
+    "auto" uses inotify when the process keeps running (the daemon) and it is
+    available, and scanning otherwise.
+
+    """
+    if backend not in WATCHER_BACKENDS:
+        raise ValueError(f'Unknown watcher "{backend}", must be one of: {", ".join(WATCHER_BACKENDS)}')
+    if backend == "inotify" or (backend == "auto" and long_running):
+        try:
+            return InotifyWatcher(local_path, name, path_filter=path_filter)
+        except OSError as exc:
+            if backend == "inotify":
+                raise
+            logging.getLogger(name).info(f"inotify not available ({exc}), scanning {local_path} instead")
+    return PollingWatcher(local_path, directory, name, path_filter=path_filter)
@@ -8,7 +8,7 @@ setup(
     author="Chris Scott",
     author_email="chris.scott@nesi.org.nz",
     license="MIT",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks"]),
     install_requires=["globus_sdk>=3"],
     entry_points={
         "console_scripts": ["sync_directory=globus_sync_directory.__main__:main"]